@@ -0,0 +1,196 @@
+# Локальная замена VK API для нагрузочного тестирования бота
+import asyncio
+import json
+import re
+import time
+from collections import deque
+
+from aiohttp import web
+
+CALL_RE = re.compile(r"API\.([\w.]+)\(")
+
+TOO_MANY_REQUESTS = 6
+
+
+class FakeVk(object):
+    """Сервер, отвечающий на execute, messages.getLongPollServer, messages.send и запросы Long Poll
+
+    latency - задержка ответа на каждый запрос к API в секундах,
+    rate_limit - сколько запросов в секунду разрешено одному токену (0 - без ограничений),
+    expected - сколько всего сообщений будет отправлено боту: all_replied устанавливается, когда бот
+    ответит на все (0 - на все уже отправленные, даже если отправлены ещё не все).
+    Сообщения для бота добавляются через push_message, ответы бота собираются в replies.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, rate_limit: int = 0,
+                 expected: int = 0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.expected = expected
+
+        self.runner = None
+
+        # События Long Poll. Номер события в списке - его ts
+        self.events = []
+        self.new_events = asyncio.Event()
+
+        # message_id -> время, когда сообщение "пришло" в ВК
+        self.pushed = {}
+        # message_id -> время ответа бота
+        self.replies = {}
+        self.all_replied = asyncio.Event()
+
+        self.http_requests = 0
+        self.api_calls = 0
+        self.rate_limited = 0
+        self.requests_by_token = {}
+
+        self.message_id = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def api_url(self) -> str:
+        return self.url + "/method/"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_route("*", "/method/{method}", self.handle_method)
+        app.router.add_get("/lp", self.handle_long_poll)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+
+        if not self.port:
+            self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def push_message(self, peer_id: int, text: str) -> int:
+        """Добавляет входящее личное сообщение в Long Poll. Возвращает его id"""
+        self.message_id += 1
+
+        self.pushed[self.message_id] = time.monotonic()
+        self.events.append([4, self.message_id, 1, peer_id, int(time.time()), " ... ", text, {}])
+        self.new_events.set()
+
+        return self.message_id
+
+    def limited(self, token: str) -> bool:
+        if not self.rate_limit:
+            return False
+
+        now = time.monotonic()
+        window = self.requests_by_token.setdefault(token, deque())
+
+        while window and now - window[0] >= 1:
+            window.popleft()
+
+        if len(window) >= self.rate_limit:
+            return True
+
+        window.append(now)
+
+        return False
+
+    @staticmethod
+    def error(code: int, message: str) -> web.Response:
+        return web.json_response({"error": {"error_code": code, "error_msg": message, "request_params": []}})
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        self.http_requests += 1
+
+        params = dict(request.query)
+        params.update(await request.post())
+
+        method = request.match_info["method"]
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.limited(params.get("access_token", "")):
+            self.rate_limited += 1
+            return self.error(TOO_MANY_REQUESTS, "Too many requests per second")
+
+        if method != "execute":
+            self.api_calls += 1
+            return web.json_response({"response": self.call(method, params)})
+
+        calls = self.parse_code(params.get("code", ""))
+        self.api_calls += len(calls)
+
+        results = [self.call(name, data) for name, data in calls]
+
+        # "return API.method();" возвращает результат метода, "return [API..., ...];" - массив результатов
+        if not params.get("code", "").lstrip().startswith("return ["):
+            return web.json_response({"response": results[0] if results else None})
+
+        return web.json_response({"response": results})
+
+    @staticmethod
+    def parse_code(code: str) -> list:
+        """Возвращает обращения к API из кода execute в виде списка (метод, параметры)"""
+        decoder = json.JSONDecoder()
+        calls = []
+
+        for match in CALL_RE.finditer(code):
+            idx = match.end()
+
+            try:
+                data, _ = decoder.raw_decode(code, idx)
+            except ValueError:
+                data = {}
+
+            calls.append((match.group(1), data if isinstance(data, dict) else {}))
+
+        return calls
+
+    def call(self, method: str, data: dict):
+        if method == "messages.send":
+            message_id = int(str(data.get("forward_messages") or 0).split(",")[0] or 0)
+
+            if message_id in self.pushed and message_id not in self.replies:
+                self.replies[message_id] = time.monotonic()
+
+                if len(self.replies) >= (self.expected or len(self.pushed)):
+                    self.all_replied.set()
+
+            return self.message_id + len(self.replies)
+
+        if method == "messages.getLongPollServer":
+            return {"server": f"{self.url}/lp", "key": "benchmark", "ts": len(self.events)}
+
+        if method == "groups.getById":
+            return [{"id": 1, "name": "Benchmark", "screen_name": "club1"}]
+
+        if method == "account.getProfileInfo":
+            return {"first_name": "Benchmark", "last_name": "User", "screen_name": "id1"}
+
+        if method == "users.get":
+            return [{"id": int(i), "first_name": "User", "last_name": str(i)}
+                    for i in str(data.get("user_ids", 1)).split(",")]
+
+        return 1
+
+    async def handle_long_poll(self, request: web.Request) -> web.Response:
+        ts = int(request.query.get("ts", 0))
+        wait = float(request.query.get("wait", 25))
+
+        if ts >= len(self.events):
+            self.new_events.clear()
+
+            try:
+                await asyncio.wait_for(self.new_events.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+        return web.json_response({"ts": len(self.events), "updates": self.events[ts:]})
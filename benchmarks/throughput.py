@@ -0,0 +1,158 @@
+"""Нагрузочный тест бота: Bot.run получает сообщения от локальной замены VK API
+
+Запуск из папки с ботом (нужны настроенные DATABASE_SETTINGS в settings.py):
+    python benchmarks/throughput.py --messages 2000 --rate 200 --latency 0.05 --rate-limit 20
+
+Бот отвечает на каждое сообщение командой бенчмарка. Выводится количество
+обработанных сообщений в секунду, задержка ответа (p50/p99) и количество
+обращений к API на одно сообщение.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_vk import FakeVk
+
+BENCH_COMMAND = "бенч"
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def configure_settings() -> None:
+    """Настройки бота для теста: один токен группы, без логов и антифлуда"""
+    import settings
+
+    settings.USERS = (("benchmark-token",),)
+    settings.PROXIES = ()
+    settings.LOG_MESSAGES = False
+    settings.LOG_COMMANDS = False
+    settings.FLOOD_INTERVAL = -1
+    settings.FORWARD_MESSAGES = True
+    settings.READ_OUT = False
+    settings.CHAT_ENABLE = False
+    settings.CHECK_FORWARDED_MESSAGES = False
+    settings.WHITELIST = settings.BLACKLIST = settings.ADMINS = ()
+    settings.ENABLED_PLUGINS = ()
+    settings.DISABLED_PLUGINS = ()
+
+
+def add_bench_command(bot) -> None:
+    from command import CommandSystem
+    from plugin_system import Plugin
+
+    plugin = Plugin("Benchmark")
+
+    @plugin.on_command(BENCH_COMMAND)
+    async def bench(msg, args):
+        await msg.answer("ok")
+
+    plugin.register(bot.plugin_system)
+
+    command_names = sorted(bot.plugin_system.commands.keys(), key=len, reverse=True)
+    bot.cmd_system = CommandSystem(command_names, bot.plugin_system)
+
+
+async def feed(fake: FakeVk, args, text: str) -> None:
+    """Отправляет сообщения боту с заданной частотой от args.peers разных пользователей"""
+    interval = 1 / args.rate if args.rate else 0
+
+    started = time.monotonic()
+
+    for i in range(args.messages):
+        fake.push_message(1 + i % args.peers, text)
+
+        if interval:
+            delay = started + (i + 1) * interval - time.monotonic()
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
+def report(fake: FakeVk, elapsed: float) -> None:
+    latencies = [fake.replies[i] - fake.pushed[i] for i in fake.replies]
+    handled = len(fake.replies)
+
+    print(f"Отправлено сообщений:     {len(fake.pushed)}")
+    print(f"Получено ответов:         {handled}")
+    print(f"Сообщений в секунду:      {handled / elapsed if elapsed else 0:.1f}")
+    print(f"Задержка ответа p50:      {percentile(latencies, 50) * 1000:.1f} мс")
+    print(f"Задержка ответа p99:      {percentile(latencies, 99) * 1000:.1f} мс")
+    print(f"HTTP запросов к API:      {fake.http_requests} ({fake.http_requests / max(handled, 1):.3f} на сообщение)")
+    print(f"Обращений к методам API:  {fake.api_calls} ({fake.api_calls / max(handled, 1):.3f} на сообщение)")
+    print(f"Ответов Too many requests: {fake.rate_limited}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальной замене VK API")
+    parser.add_argument("--messages", type=int, default=1000, help="сколько сообщений отправить боту")
+    parser.add_argument("--rate", type=float, default=0, help="сообщений в секунду (0 - все сразу)")
+    parser.add_argument("--peers", type=int, default=100, help="количество разных пользователей")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа API в секундах")
+    parser.add_argument("--rate-limit", type=int, default=20, help="запросов в секунду на токен (0 - без ограничений)")
+    parser.add_argument("--timeout", type=float, default=120, help="максимальное время теста в секундах")
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+
+    configure_settings()
+
+    loop = asyncio.get_event_loop()
+
+    fake = FakeVk(latency=args.latency, rate_limit=args.rate_limit, expected=args.messages)
+    loop.run_until_complete(fake.start())
+
+    import vkapi
+    vkapi.API_URL = fake.api_url
+
+    import settings
+    import vbot
+    from migrations import migrate
+
+    migrate()
+
+    bot = vbot.Bot()
+    add_bench_command(bot)
+
+    bot_task = loop.create_task(bot.run(loop))
+
+    async def run():
+        started = time.monotonic()
+
+        await feed(fake, args, settings.PREFIXES[0] + BENCH_COMMAND)
+
+        try:
+            await asyncio.wait_for(fake.all_replied.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            print(f"Бот не ответил на все сообщения за {args.timeout} сек.")
+
+        return time.monotonic() - started
+
+    try:
+        elapsed = loop.run_until_complete(run())
+    finally:
+        bot_task.cancel()
+        loop.run_until_complete(asyncio.gather(bot_task, return_exceptions=True))
+        loop.run_until_complete(fake.stop())
+
+        from transport import transport
+        loop.run_until_complete(transport.close())
+
+    report(fake, elapsed)
+
+
+if __name__ == "__main__":
+    main()
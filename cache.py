@@ -0,0 +1,134 @@
+# Кэши в памяти
+import time
+from collections import OrderedDict
+
+try:
+    from settings import RESPONSE_CACHE_SIZE
+except ImportError:
+    RESPONSE_CACHE_SIZE = 5000
+
+MISSING = object()
+
+
+class TTLCache(object):
+    """LRU-кэш ограниченного размера, записи которого устаревают через заданное время"""
+
+    __slots__ = ("maxsize", "items", "hits", "misses")
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.items = OrderedDict()  # ключ -> (время устаревания, значение)
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not MISSING
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+
+        if not total:
+            return 0.0
+
+        return self.hits / total
+
+    def get(self, key, default=MISSING, count=True):
+        """Возвращает значение по ключу или default, если его нет или оно устарело"""
+        item = self.items.get(key)
+
+        if item is not None:
+            if item[0] > time.monotonic():
+                self.items.move_to_end(key)
+
+                if count:
+                    self.hits += 1
+
+                return item[1]
+
+            del self.items[key]
+
+        if count:
+            self.misses += 1
+
+        return default
+
+    def set(self, key, value, ttl: float) -> None:
+        self.items[key] = (time.monotonic() + ttl, value)
+        self.items.move_to_end(key)
+
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.items.pop(key, None)
+
+        if item is None:
+            return default
+
+        return item[1]
+
+    def clear(self) -> None:
+        self.items.clear()
+
+
+# Время жизни (в секундах) закэшированных ответов методов VK API
+METHOD_TTL = {
+    'users.get': 600,
+    'groups.getById': 3600,
+    'utils.resolveScreenName': 3600,
+    'messages.getChat': 300,
+}
+
+# Методы, после вызова которых закэшированные ответы других методов устаревают
+INVALIDATED_BY = {
+    'messages.editChat': ('messages.getChat',),
+    'messages.addChatUser': ('messages.getChat',),
+    'messages.removeChatUser': ('messages.getChat',),
+    'messages.setChatPhoto': ('messages.getChat',),
+    'messages.deleteChatPhoto': ('messages.getChat',),
+}
+
+
+class ResponseCache(TTLCache):
+    """Кэш ответов редко меняющихся методов VK API
+
+    Ключ записи - (метод, ключ запроса), где ключ запроса не зависит
+    от порядка и типов параметров (см. utils.request_key).
+    """
+
+    __slots__ = ()
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE):
+        super().__init__(maxsize)
+
+    @staticmethod
+    def cacheable(key: str) -> bool:
+        return key in METHOD_TTL
+
+    def store(self, key: str, request: str, value) -> None:
+        self.set((key, request), value, METHOD_TTL[key])
+
+    def lookup(self, key: str, request: str):
+        return self.get((key, request))
+
+    def invalidate(self, key: str = None, request: str = None) -> None:
+        """Удаляет из кэша ответ на запрос, все ответы метода key или, без аргументов, весь кэш"""
+        if key is None:
+            return self.clear()
+
+        if request is not None:
+            self.pop((key, request))
+            return
+
+        for cached in [k for k in self.items if k[0] == key]:
+            del self.items[cached]
+
+    def invalidate_related(self, key: str) -> None:
+        """Удаляет ответы методов, которые устарели после вызова метода key"""
+        for related in INVALIDATED_BY.get(key, ()):
+            self.invalidate(related)
@@ -0,0 +1,66 @@
+# Разбор JSON ответов ВК. Использует orjson или ujson, если они установлены
+import json
+from typing import Iterator, Union
+
+try:
+    import orjson as _fast_json
+
+    NAME = "orjson"
+except ImportError:
+    try:
+        import ujson as _fast_json
+
+        NAME = "ujson"
+    except ImportError:
+        _fast_json = None
+
+        NAME = "json"
+
+_decoder = json.JSONDecoder(strict=False)
+
+
+def _text(data: Union[bytes, str]) -> str:
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return bytes(data).decode("utf-8", "replace")
+
+    return data
+
+
+def loads(data: Union[bytes, str]):
+    """Разбирает один JSON объект из байтов (или строки) без промежуточного перевода в str"""
+    if _fast_json is not None:
+        try:
+            return _fast_json.loads(data)
+        except ValueError:
+            # Управляющие символы в строках и т.п. - пробуем разобрать стандартным модулем
+            pass
+
+    return _decoder.decode(_text(data).strip())
+
+
+def iter_loads(data: Union[bytes, str]) -> Iterator:
+    """Разбирает один или несколько JSON объектов, идущих подряд
+
+    Обычно ответ состоит из одного объекта, и он разбирается за один вызов
+    быстрой библиотеки. Только если это не удалось, ответ разбирается по частям.
+    """
+    if _fast_json is not None:
+        try:
+            yield _fast_json.loads(data)
+            return
+        except ValueError:
+            pass
+
+    text = _text(data)
+
+    idx = 0
+    end = len(text)
+
+    while idx < end:
+        if text[idx].isspace():
+            idx += 1
+            continue
+
+        obj, idx = _decoder.raw_decode(text, idx)
+
+        yield obj
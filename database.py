@@ -1,9 +1,15 @@
+import asyncio
 import time
+import traceback
+from collections import OrderedDict
+from typing import Optional, Tuple
 
 import hues
 import peewee
 import peewee_async
 
+from metrics import DB_QUERY_SECONDS
+
 try:
     from settings import DATABASE_SETTINGS, DATABASE_DRIVER, DATABASE_CHARSET
     s = True
@@ -12,6 +18,16 @@ except:
     DATABASE_SETTINGS, DATABASE_DRIVER, DATABASE_CHARSET = (), None, "utf8mb4"
     s = False
 
+try:
+    from settings import USER_CACHE_SIZE, USER_CACHE_WRITE_BEHIND, USER_CACHE_FLUSH_INTERVAL
+except ImportError:
+    USER_CACHE_SIZE, USER_CACHE_WRITE_BEHIND, USER_CACHE_FLUSH_INTERVAL = 10000, True, 5
+
+try:
+    from settings import USER_CACHE_TTL
+except ImportError:
+    USER_CACHE_TTL = 0
+
 _additional_values = {}
 if DATABASE_DRIVER == "mysql":
     driver = peewee_async.MySQLDatabase
@@ -50,24 +66,35 @@ async def set_up_roles(bot):
     if WHITELIST:
         bot.WHITELISTED = True
 
-    for u in WHITELIST:
-        await db.get_or_create(Role, user_id=u, role="whitelisted")
-
-    for u in BLACKLIST:
-        await db.get_or_create(Role, user_id=u, role="blacklisted")
+    await role_index.load()
 
-    for u in ADMINS:
-        await db.get_or_create(Role, user_id=u, role="admin")
+    # Добавляем роли из настроек, которых ещё нет в БД, одним запросом
+    await role_index.add_roles((u, role)
+                               for role, ids in (("whitelisted", WHITELIST),
+                                                 ("blacklisted", BLACKLIST),
+                                                 ("admin", ADMINS))
+                               for u in ids)
 
     await check_white_list(bot)
 
 
 async def check_white_list(bot):
-    if await db.count(Role.select().where(Role.role == "whitelisted")) > 0:
-        bot.WHITELISTED = True
+    if not role_index.loaded:
+        await role_index.load()
+
+    bot.WHITELISTED = bool(role_index.members("whitelisted"))
+
+
+class Manager(peewee_async.Manager):
+    """Менеджер запросов, который учитывает время выполнения запросов в метриках"""
+
+    async def execute(self, query):
+        with DB_QUERY_SECONDS.time(type(query).__name__):
+            return await super().execute(query)
 
-    else:
-        bot.WHITELISTED = False
+    async def count(self, query, clear_limit=False):
+        with DB_QUERY_SECONDS.time("Count"):
+            return await super().count(query, clear_limit)
 
 
 #############################################################################################
@@ -105,13 +132,235 @@ class BotStatus(BaseModel):
     timestamp = peewee.IntegerField(default=time.time)
 
 
-if database:
-    db = peewee_async.Manager(database)
+class RoleIndex(object):
+    """Роли пользователей из таблицы Role в памяти
+
+    Роли загружаются из БД один раз (load) и меняются через add_role и remove_role.
+    Если роли были изменены в БД напрямую (например, другим процессом), нужно вызвать reload.
+    """
+
+    __slots__ = ("roles", "loaded")
+
+    def __init__(self):
+        self.roles = {}  # роль -> множество user_id
+        self.loaded = False
+
+    async def load(self) -> None:
+        roles = {}
+
+        for row in await db.execute(Role.select()):
+            roles.setdefault(row.role, set()).add(row.user_id)
+
+        self.roles = roles
+        self.loaded = True
+
+    reload = load
+
+    def has(self, user_id: int, role: str) -> bool:
+        return user_id in self.roles.get(role, ())
+
+    def members(self, role: str) -> set:
+        return self.roles.get(role, set())
+
+    async def add_role(self, user_id: int, role: str) -> None:
+        await self.add_roles(((user_id, role),))
+
+    async def add_roles(self, pairs) -> None:
+        """Добавляет роли (пары user_id, роль), которых ещё нет, одним запросом"""
+        missing = []
+
+        for user_id, role in pairs:
+            if not self.has(user_id, role) and (user_id, role) not in missing:
+                missing.append((user_id, role))
+
+        if not missing:
+            return
+
+        await db.execute(Role.insert_many([{"user_id": user_id, "role": role} for user_id, role in missing]))
+
+        for user_id, role in missing:
+            self.roles.setdefault(role, set()).add(user_id)
+
+    async def remove_role(self, user_id: int, role: str) -> None:
+        await db.execute(Role.delete().where((Role.user_id == user_id) & (Role.role == role)))
+
+        self.members(role).discard(user_id)
+
+
+class UserCache(object):
+    """Загруженные из БД пользователи, чтобы не читать пользователя из БД на каждое сообщение
+
+    Для каждого пользователя хранится один объект User, поэтому все, кто получил его
+    через кэш (включая плагины), видят изменения друг друга. Если write_behind включён,
+    изменённые через save поля записываются в БД пачкой раз в flush_interval секунд
+    и при выключении бота (flush), иначе - сразу.
+
+    Пользователь перечитывается из БД, если загружен больше ttl секунд назад (None - не
+    перечитывается). Незаписанные изменения при этом переносятся в новый объект.
+    """
+
+    __slots__ = ("maxsize", "write_behind", "flush_interval", "ttl", "users", "dirty", "flusher", "hits", "misses")
+
+    # Сколько пользователей обновлять одним запросом
+    FLUSH_CHUNK = 500
+
+    def __init__(self, maxsize: int=USER_CACHE_SIZE, write_behind: bool=USER_CACHE_WRITE_BEHIND,
+                 flush_interval: float=USER_CACHE_FLUSH_INTERVAL, ttl: Optional[float]=USER_CACHE_TTL or None):
+        self.maxsize = maxsize
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+
+        self.users = OrderedDict()  # user_id -> (User, время загрузки)
+        self.dirty = {}  # user_id -> (User, множество изменённых полей)
+
+        self.flusher = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def share(self) -> None:
+        """Пользователей меняют и другие процессы: перечитывать пользователя при каждом обращении
+        и сразу записывать изменения, чтобы не затереть чужие"""
+        self.ttl = 0
+        self.write_behind = False
+
+    def remember(self, user: User) -> User:
+        self.users[user.user_id] = (user, time.monotonic())
+        self.users.move_to_end(user.user_id)
 
-    User.create_table(True)
-    BotStatus.create_table(True)
-    Role.create_table(True)
-    Status.create_table(True)
+        # Вытесненный пользователь с незаписанными изменениями остаётся в dirty до записи в БД
+        while len(self.users) > self.maxsize:
+            self.users.popitem(last=False)
+
+        return user
+
+    async def get(self, user_id: int) -> Optional[User]:
+        cached = self.users.get(user_id)
+
+        if cached is not None and (self.ttl is None or time.monotonic() - cached[1] < self.ttl):
+            self.hits += 1
+            self.users.move_to_end(user_id)
+
+            return cached[0]
+
+        self.misses += 1
+
+        pending = self.dirty.get(user_id)
+
+        # Вытесненный из кэша пользователь с незаписанными изменениями - самый свежий
+        if pending is not None and self.ttl is None:
+            return self.remember(pending[0])
+
+        user = await get_or_none(User, user_id=user_id)
+
+        if pending is not None:
+            if user is None:
+                return self.remember(pending[0])
+
+            changed, fields = pending
+
+            for field in fields:
+                setattr(user, field, getattr(changed, field))
+
+            self.dirty[user_id] = (user, fields)
+
+        if user is None:
+            self.users.pop(user_id, None)
+            return None
+
+        return self.remember(user)
+
+    async def get_or_create(self, user_id: int) -> Tuple[User, bool]:
+        user = await self.get(user_id)
+
+        if user is not None:
+            return user, False
+
+        user, created = await db.get_or_create(User, user_id=user_id)
+
+        return self.remember(user), created
+
+    async def save(self, user: User, *fields: str) -> None:
+        """Сохраняет изменённые поля пользователя (сразу или при следующей записи)"""
+        if not self.write_behind:
+            await db.update(user, only=[getattr(User, field) for field in fields])
+            return
+
+        pending = self.dirty.get(user.user_id)
+
+        if pending is None:
+            self.dirty[user.user_id] = (user, set(fields))
+        elif pending[0] is not user:
+            # Пользователь перечитан из БД, а изменён старый объект
+            self.dirty[user.user_id] = (user, pending[1] | set(fields))
+        else:
+            pending[1].update(fields)
+
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush_periodically())
+
+    async def flush(self) -> None:
+        """Записывает все незаписанные изменения в БД"""
+        if not self.dirty:
+            return
+
+        dirty, self.dirty = self.dirty, {}
+
+        # Пользователи, у которых изменилось поле -> значения поля
+        by_field = {}
+
+        for user_id, (user, fields) in dirty.items():
+            for field in fields:
+                by_field.setdefault(field, []).append((user_id, getattr(user, field)))
+
+        try:
+            for field, values in by_field.items():
+                for i in range(0, len(values), self.FLUSH_CHUNK):
+                    chunk = values[i:i + self.FLUSH_CHUNK]
+
+                    # UPDATE user SET field = CASE user_id WHEN ... THEN ... END WHERE user_id IN (...)
+                    query = User.update(**{field: peewee.Case(User.user_id, chunk)}) \
+                        .where(User.user_id << [user_id for user_id, _ in chunk])
+
+                    await db.execute(query)
+
+        except asyncio.CancelledError:
+            self.restore(dirty)
+            raise
+
+        except Exception:
+            hues.error("Не удалось записать изменения пользователей в БД")
+            traceback.print_exc()
+
+            self.restore(dirty)
+
+    def restore(self, dirty: dict) -> None:
+        """Возвращает незаписанные изменения, чтобы записать их в следующий раз"""
+        for user_id, (user, fields) in dirty.items():
+            pending = self.dirty.setdefault(user_id, (user, set()))
+            pending[1].update(fields)
+
+    async def flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self) -> None:
+        """Останавливает периодическую запись и записывает оставшиеся изменения"""
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+
+        await self.flush()
+
+
+role_index = RoleIndex()
+user_cache = UserCache()
+
+
+if database:
+    db = Manager(database)
 
 elif s:
     hues.error("Не удалось создать базу данных! Проверьте настройки и попробуйте снова!")
\ No newline at end of file
@@ -0,0 +1,154 @@
+# Обработка событий Long Poll и Callback API ограниченным числом обработчиков
+import asyncio
+import traceback
+from itertools import count
+from typing import Awaitable, Callable, Optional
+
+import hues
+
+from metrics import EVENT_LAG_SECONDS, EVENTS_IN_FLIGHT, EVENTS_QUEUED
+from utils import schedule_coroutine
+
+try:
+    from settings import EVENT_WORKERS, EVENT_QUEUE_SIZE
+except ImportError:
+    EVENT_WORKERS, EVENT_QUEUE_SIZE = 50, 1000
+
+
+def event_peer(event) -> Optional[int]:
+    """Возвращает ID диалога, к которому относится событие Long Poll (список) или Callback API (словарь)"""
+    if isinstance(event, list):
+        # [4, message_id, flags, peer_id, ...] - новое сообщение
+        if len(event) > 3 and event[0] == 4:
+            return event[3]
+
+        return None
+
+    if isinstance(event, dict):
+        obj = event.get("object")
+
+        if isinstance(obj, dict):
+            if obj.get("chat_id"):
+                return 2000000000 + obj["chat_id"]
+
+            return obj.get("peer_id") or obj.get("user_id")
+
+    return None
+
+
+class EventDispatcher(object):
+    """Очереди событий и обработчики, которые берут из них события
+
+    События распределяются по workers очередям по ID диалога: события одного диалога
+    попадают в одну очередь и обрабатываются по порядку одним обработчиком, а события
+    разных диалогов обрабатываются параллельно. Всего в очередях может ждать не больше
+    maxsize событий: если места нет, put ждёт его освобождения, а put_nowait возвращает False.
+    """
+
+    __slots__ = ("handler", "key", "workers", "shards", "maxsize", "not_full", "queued", "rotation",
+                 "tasks", "in_flight", "processed", "lag")
+
+    def __init__(self, handler: Callable[..., Awaitable], workers: int=EVENT_WORKERS, maxsize: int=EVENT_QUEUE_SIZE,
+                 key: Callable[..., Optional[int]]=event_peer):
+        self.handler = handler
+        self.key = key
+        self.workers = max(1, workers)
+
+        self.shards = [asyncio.Queue() for _ in range(self.workers)]
+        self.maxsize = maxsize
+
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+        # События без диалога распределяются по очередям по кругу
+        self.rotation = count()
+
+        self.tasks = []
+
+        # Сколько событий ждёт в очередях, обрабатывается прямо сейчас и обработано всего
+        self.queued = 0
+        self.in_flight = 0
+        self.processed = 0
+
+        # Сколько секунд ждало в очереди последнее взятое в обработку событие
+        self.lag = 0.0
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self.queued
+
+    def shard(self, event) -> int:
+        """Номер очереди для события"""
+        peer = self.key(event)
+
+        if peer is None:
+            return next(self.rotation) % self.workers
+
+        if not isinstance(peer, int):
+            peer = hash(peer)
+
+        return peer % self.workers
+
+    def start(self) -> None:
+        if self.tasks:
+            return
+
+        self.tasks = [schedule_coroutine(self.work(shard)) for shard in self.shards]
+
+        EVENTS_QUEUED.track(lambda: self.queued)
+        EVENTS_IN_FLIGHT.track(lambda: self.in_flight)
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        self.tasks = []
+
+    async def put(self, event) -> None:
+        """Добавляет событие в очередь, дождавшись свободного места"""
+        while self.full():
+            self.not_full.clear()
+            await self.not_full.wait()
+
+        self.put_nowait(event)
+
+    def put_nowait(self, event) -> bool:
+        """Добавляет событие в очередь. Возвращает False, если очереди заполнены"""
+        if self.full():
+            return False
+
+        self.shards[self.shard(event)].put_nowait((asyncio.get_event_loop().time(), event))
+        self.queued += 1
+
+        return True
+
+    async def join(self) -> None:
+        """Ждёт, пока все события из очередей не будут обработаны"""
+        for shard in self.shards:
+            await shard.join()
+
+    async def work(self, shard: asyncio.Queue) -> None:
+        while True:
+            queued_at, event = await shard.get()
+
+            self.queued -= 1
+            self.not_full.set()
+
+            self.lag = asyncio.get_event_loop().time() - queued_at
+            EVENT_LAG_SECONDS.observe(self.lag)
+
+            self.in_flight += 1
+
+            try:
+                await self.handler(event)
+
+            except Exception:
+                hues.error("Ошибка при обработке события")
+                traceback.print_exc()
+
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+
+                shard.task_done()
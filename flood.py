@@ -0,0 +1,73 @@
+# Антифлуд: ограничение частоты сообщений от пользователей и в беседах
+import time
+from collections import OrderedDict
+
+from utils import TokenBucket
+
+try:
+    from settings import FLOOD_INTERVAL
+except ImportError:
+    FLOOD_INTERVAL = 1
+
+try:
+    from settings import FLOOD_BURST, FLOOD_PEER_INTERVAL, FLOOD_PEER_BURST, FLOOD_LIMITER_SIZE
+except ImportError:
+    FLOOD_BURST, FLOOD_PEER_INTERVAL, FLOOD_PEER_BURST, FLOOD_LIMITER_SIZE = 3, 0.2, 10, 10000
+
+
+class RateLimiter(object):
+    """Ограничители частоты "ведро с токенами" для множества ключей
+
+    На каждый ключ можно отправить burst сообщений подряд, дальше - одно раз в interval секунд.
+    Хранится не больше maxsize ключей: давно не писавшие забываются.
+    """
+
+    __slots__ = ("burst", "interval", "maxsize", "buckets")
+
+    def __init__(self, interval: float, burst: int, maxsize: int):
+        self.burst = max(1, burst)
+        self.interval = interval
+        self.maxsize = maxsize
+
+        self.buckets = OrderedDict()  # ключ -> TokenBucket
+
+    def allow(self, key, now: float) -> bool:
+        if self.interval <= 0:
+            return True
+
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.burst, self.burst * self.interval)
+
+            if len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+
+        else:
+            self.buckets.move_to_end(key)
+
+        return not bucket.try_acquire(now)
+
+
+class FloodLimiter(object):
+    """Антифлуд для входящих сообщений: отдельно для каждого пользователя и для каждой беседы"""
+
+    __slots__ = ("users", "peers")
+
+    def __init__(self, interval: float=FLOOD_INTERVAL, burst: int=FLOOD_BURST,
+                 peer_interval: float=FLOOD_PEER_INTERVAL, peer_burst: int=FLOOD_PEER_BURST,
+                 maxsize: int=FLOOD_LIMITER_SIZE):
+        self.users = RateLimiter(interval, burst, maxsize)
+        self.peers = RateLimiter(peer_interval, peer_burst, maxsize)
+
+    def check(self, user_id: int, peer_id: int=None) -> str:
+        """Возвращает пустую строку, если сообщение можно обработать, иначе - что превысило лимит ("user" или "peer")"""
+        now = time.monotonic()
+
+        if not self.users.allow(user_id, now):
+            return "user"
+
+        if peer_id is not None and not self.peers.allow(peer_id, now):
+            return "peer"
+
+        return ""
@@ -1,5 +1,7 @@
 import hues
 
+from utils import Priority
+
 # Словарь, ключ - раздел API методов, значение - список разрешённых методов
 ALLOWED_METHODS = {
     'groups': ('getById',
@@ -103,4 +105,38 @@ def is_available_from_public(key: str) -> bool:
         return False
     methods = ALLOWED_PUBLIC.get(topic, ())
     if method in methods:
-        return True
\ No newline at end of file
+        return True
+
+
+# Методы, от которых зависит скорость ответа пользователю
+HIGH_PRIORITY_METHODS = ('messages.send',
+                         'messages.getById',
+                         'messages.edit')
+# Методы, которые можно выполнить позже остальных
+LOW_PRIORITY_METHODS = ('messages.markAsRead',
+                        'messages.setActivity')
+
+
+def method_priority(key: str) -> Priority:
+    """Возвращает приоритет метода VK API по умолчанию"""
+    if key in HIGH_PRIORITY_METHODS:
+        return Priority.HIGH
+
+    if key in LOW_PRIORITY_METHODS:
+        return Priority.LOW
+
+    return Priority.NORMAL
+
+
+# Префиксы методов, которые только читают данные и не имеют побочных эффектов
+READ_ONLY_PREFIXES = ('get', 'search', 'resolve', 'is', 'check')
+
+
+def is_read_only(key: str) -> bool:
+    """Проверяет, что метод VK API только читает данные"""
+    try:
+        topic, method = key.split('.')
+    except ValueError:
+        return False
+
+    return method.startswith(READ_ONLY_PREFIXES)
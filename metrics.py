@@ -0,0 +1,229 @@
+# Метрики работы бота в текстовом формате Prometheus
+import time
+from bisect import bisect_left
+from typing import Callable, Sequence
+
+import hues
+from aiohttp import web
+
+try:
+    from settings import METRICS_HOST, METRICS_PORT
+except ImportError:
+    METRICS_HOST, METRICS_PORT = "127.0.0.1", 0
+
+# Границы корзин гистограмм времени (в секундах)
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """Метрика с необязательными метками. Значения меток передаются по порядку labelnames
+
+    Вместо значения можно передать функцию (track), которая вызывается при сборе метрик -
+    так экспортируются счётчики, которые объекты бота ведут сами.
+    """
+
+    type = "untyped"
+
+    __slots__ = ("name", "help", "labelnames", "values")
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+        self.values = {}  # значения меток -> значение
+
+        registry.register(self)
+
+    def track(self, function: Callable[[], float], *labels) -> None:
+        self.values[labels] = function
+
+    def remove(self, *labels) -> None:
+        self.values.pop(labels, None)
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, "", value() if callable(value) else value
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {_escape(self.help)}", f"# TYPE {self.name} {self.type}"]
+
+        for name, labels, extra, value in self.samples():
+            lines.append(f"{name}{_labels(self.labelnames, labels, extra)} {_number(value)}")
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    __slots__ = ()
+
+    def inc(self, *labels, amount=1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Текущее значение"""
+
+    type = "gauge"
+
+    __slots__ = ()
+
+    def set(self, value, *labels) -> None:
+        self.values[labels] = value
+
+
+class _Timer(object):
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.started, *self.labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    __slots__ = ("buckets",)
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = TIME_BUCKETS):
+        super().__init__(name, help, labelnames)
+
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels) -> None:
+        state = self.values.get(labels)
+
+        if state is None:
+            # Количество значений в каждой корзине (последняя - +Inf), сумма значений
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
+
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def time(self, *labels) -> _Timer:
+        """Контекстный менеджер, измеряющий время выполнения блока"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+
+                yield self.name + "_bucket", labels, f'le="{_number(bound)}"', cumulative
+
+            yield self.name + "_sum", labels, "", total
+            yield self.name + "_count", labels, "", cumulative
+
+
+class Registry(object):
+    __slots__ = ("metrics", "server")
+
+    def __init__(self):
+        self.metrics = []
+        self.server = None
+
+    def register(self, metric: Metric) -> None:
+        self.metrics.append(metric)
+
+    def expose(self) -> str:
+        return "\n".join(metric.expose() for metric in self.metrics) + "\n"
+
+    async def handle(self, request):
+        return web.Response(text=self.expose(), content_type="text/plain", charset="utf-8")
+
+    async def start_server(self, host: str = METRICS_HOST, port: int = METRICS_PORT) -> None:
+        """Запускает HTTP сервер с метриками по адресу http://host:port/metrics. port = 0 - не запускать"""
+        if not port or self.server is not None:
+            return
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+
+        try:
+            await web.TCPSite(runner, host, port).start()
+        except OSError as e:
+            hues.warn(f"Не удалось запустить сервер метрик на {host}:{port}: {e}")
+            await runner.cleanup()
+            return
+
+        self.server = runner
+
+        hues.info(f"Метрики доступны по адресу http://{host}:{port}/metrics")
+
+    async def stop_server(self) -> None:
+        if self.server is not None:
+            await self.server.cleanup()
+
+            self.server = None
+
+
+registry = Registry()
+
+VK_CALL_SECONDS = Histogram("vk_call_seconds", "Время выполнения метода VK API с момента постановки в очередь",
+                            ("method",))
+VK_CALL_ERRORS = Counter("vk_call_errors_total", "Ошибки методов VK API", ("method", "code"))
+VK_EXECUTE_SECONDS = Histogram("vk_execute_seconds", "Время выполнения HTTP запроса execute")
+VK_EXECUTE_BATCH_SIZE = Histogram("vk_execute_batch_size", "Количество обращений к API в одном execute",
+                                  buckets=(1, 2, 3, 5, 10, 15, 20, 25))
+VK_QUEUE_DEPTH = Gauge("vk_queue_depth", "Количество запросов в очереди аккаунта", ("client",))
+VK_QUEUE_DROPPED = Counter("vk_queue_dropped_total", "Запросы, отброшенные переполненной очередью аккаунта",
+                           ("client",))
+VK_QUEUE_DELAYED = Counter("vk_queue_delayed_total", "Запросы, ждавшие места в очереди аккаунта", ("client",))
+VK_EXECUTE_FILL_RATIO = Gauge("vk_execute_fill_ratio", "Средняя заполненность execute обращениями к API",
+                              ("client",))
+VK_EXECUTE_CODE_BYTES = Counter("vk_execute_code_bytes_total", "Размер кода отправленных execute в байтах",
+                                ("client",))
+VK_CACHE_HITS = Counter("vk_cache_hits_total", "Ответы методов VK API, взятые из кэша")
+VK_CACHE_MISSES = Counter("vk_cache_misses_total", "Запросы кэшируемых методов VK API, не найденные в кэше")
+VK_REQUESTS_COALESCED = Counter("vk_requests_coalesced_total",
+                                "Запросы на чтение, присоединённые к такому же выполняющемуся запросу")
+
+LONGPOLL_CYCLE_SECONDS = Histogram("longpoll_cycle_seconds", "Время одного запроса к серверу Long Poll",
+                                   buckets=(0.1, 0.5, 1, 5, 10, 20, 25, 30, 60))
+MESSAGES_HANDLED = Counter("messages_handled_total", "Обработанные сообщения")
+MESSAGES_FLOOD_REJECTED = Counter("messages_flood_rejected_total", "Сообщения, отброшенные антифлудом",
+                                  ("limit",))
+EVENTS_QUEUED = Gauge("events_queued", "События, ожидающие обработки")
+EVENTS_IN_FLIGHT = Gauge("events_in_flight", "События, обрабатываемые прямо сейчас")
+EVENT_LAG_SECONDS = Histogram("event_lag_seconds", "Сколько событие ждало в очереди до начала обработки")
+EVENTS_REJECTED = Counter("events_rejected_total", "События, отклонённые из-за заполненной очереди")
+EVENTS_DUPLICATE = Counter("events_duplicate_total", "Повторно доставленные события Callback API")
+CALLBACK_DEDUP_HIT_RATE = Gauge("callback_dedup_hit_rate", "Доля повторных доставок среди проверенных событий Callback API")
+
+PLUGIN_HANDLER_SECONDS = Histogram("plugin_handler_seconds", "Время обработки сообщения обработчиком плагина",
+                                   ("handler",))
+
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Время выполнения запроса к базе данных", ("query",))
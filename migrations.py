@@ -0,0 +1,96 @@
+# Миграции схемы БД. Запускаются при старте бота или вручную: python migrations.py
+import time
+
+import hues
+import peewee
+
+from database import BaseModel, BotStatus, DATABASE_DRIVER, Role, Status, User, database
+
+
+class SchemaVersion(BaseModel):
+    """Применённые миграции"""
+    version = peewee.IntegerField(primary_key=True)
+    applied = peewee.IntegerField(default=time.time)
+
+
+def table(model) -> str:
+    """Имя таблицы модели в кавычках, принятых в используемой БД"""
+    name = getattr(model._meta, "table_name", None) or model._meta.db_table
+    quote = "`" if DATABASE_DRIVER == "mysql" else '"'
+
+    return quote + name + quote
+
+
+def text_column(name: str) -> str:
+    """Текстовый столбец для индекса. MySQL индексирует только начало TEXT-столбцов"""
+    if DATABASE_DRIVER == "mysql":
+        return f"{name}(191)"
+
+    return name
+
+
+def create_tables():
+    for model in (User, BotStatus, Role, Status):
+        model.create_table(True)
+
+
+def add_unique_indexes():
+    # Сначала удаляем повторяющиеся строки, иначе уникальный индекс не создать.
+    # Из ролей оставляем любую, из статусов - последний записанный
+    database.execute_sql(f"DELETE FROM {table(Role)} WHERE id NOT IN "
+                         f"(SELECT id FROM (SELECT MIN(id) AS id FROM {table(Role)} "
+                         f"GROUP BY user_id, role) AS keep)")
+
+    database.execute_sql(f"DELETE FROM {table(Status)} WHERE id NOT IN "
+                         f"(SELECT id FROM (SELECT MAX(id) AS id FROM {table(Status)} "
+                         f"GROUP BY user_id, plugin_id) AS keep)")
+
+    database.execute_sql(f"CREATE UNIQUE INDEX role_user_id_role "
+                         f"ON {table(Role)} (user_id, {text_column('role')})")
+
+    database.execute_sql(f"CREATE UNIQUE INDEX status_user_id_plugin_id "
+                         f"ON {table(Status)} (user_id, {text_column('plugin_id')})")
+
+
+# Номер версии схемы, описание и функция, которая переводит схему на эту версию.
+# Новые миграции добавляются в конец списка
+MIGRATIONS = (
+    (1, "Создание таблиц", create_tables),
+    (2, "Уникальные индексы Role(user_id, role) и Status(user_id, plugin_id)", add_unique_indexes),
+)
+
+
+def current_version() -> int:
+    if not SchemaVersion.table_exists():
+        return 0
+
+    return SchemaVersion.select(peewee.fn.MAX(SchemaVersion.version)).scalar() or 0
+
+
+def migrate() -> None:
+    """Применяет миграции, которые ещё не были применены"""
+    if not database:
+        return
+
+    version = current_version()
+
+    pending = [migration for migration in MIGRATIONS if migration[0] > version]
+
+    if not pending:
+        return
+
+    SchemaVersion.create_table(True)
+
+    for number, description, function in pending:
+        hues.info(f"Миграция БД {number}: {description}")
+
+        with database.atomic():
+            function()
+
+            SchemaVersion.create(version=number)
+
+    hues.success(f"Схема БД обновлена до версии {pending[-1][0]}")
+
+
+if __name__ == '__main__':
+    migrate()
@@ -11,12 +11,19 @@ from os.path import isfile
 
 import settings
 from database import *
+from metrics import PLUGIN_HANDLER_SECONDS
 
 try:
     from settings import ENABLED_PLUGINS, DATABASE_SETTINGS, IS_GROUP
 except ImportError:
     ENABLED_PLUGINS, DATABASE_SETTINGS, IS_GROUP = None, None, False
 
+# Выполняет ли этот процесс периодические задачи плагинов (Plugin.schedule). При WORKER_PROCESSES > 0
+# плагины загружаются в каждом процессе-обработчике, а задачи выполняет только первый из них -
+# иначе, например, рассылка отправлялась бы столько раз, сколько процессов. Плагины, которые
+# запускают фоновую работу сами, тоже должны проверять этот флаг
+primary_process = True
+
 
 class Stopper:
     __slots__ = ("stop", "sleep")
@@ -85,7 +92,7 @@ class Plugin(object):
         else:
             user.status_locked_message = message
 
-        await db.update(user)
+        await user_cache.save(user, "status", "status_locked_message")
 
         return True, ""
 
@@ -97,7 +104,7 @@ class Plugin(object):
         user.status = None
         user.status_locked_message = None
 
-        await db.update(user)
+        await user_cache.save(user, "status", "status_locked_message")
 
         return True
 
@@ -153,6 +160,14 @@ class Plugin(object):
     def schedule(seconds):
         def decorator(func):
             async def wrapper(*args, **kwargs):
+                from utils import Priority, request_priority
+
+                if not primary_process:
+                    return
+
+                # Запросы к VK API из периодических задач не должны задерживать ответы пользователям
+                request_priority.set(Priority.LOW)
+
                 stopper = Stopper(seconds)
                 while not stopper.stop:
                     # Спим указанное кол-во секунд
@@ -315,11 +330,19 @@ class PluginSystem(object):
 
         if command.has_prefix and command.command:  # Если есть смысл обработать команду
             for command_function in commands_:
-                result = True if result else await self.command_wrapper(command_function, *args, **kwargs) is not False
+                if result:
+                    break
+
+                with PLUGIN_HANDLER_SECONDS.time(command.command):
+                    result = await self.command_wrapper(command_function, *args, **kwargs) is not False
 
         if not result and self.on_messages:  # Сообщение не обработано командами
             for func in self.on_messages:
-                result = True if result else await self.command_wrapper(func, *args, **kwargs) is not False
+                if result:
+                    break
+
+                with PLUGIN_HANDLER_SECONDS.time("on_message"):
+                    result = await self.command_wrapper(func, *args, **kwargs) is not False
 
         return result
 
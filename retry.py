@@ -0,0 +1,119 @@
+# Политика повторов запросов и защита от запросов к неработающему сервису
+import random
+import time
+from typing import Dict
+
+
+class RetryRule(object):
+    """Правило повтора для одного кода ошибки
+
+    attempts - сколько всего раз можно отправить запрос (1 - не повторять),
+    base и cap - начальная и максимальная задержка перед повтором в секундах.
+    """
+
+    __slots__ = ("attempts", "base", "cap")
+
+    def __init__(self, attempts: int, base: float=0.5, cap: float=10):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+
+class RetryPolicy(object):
+    """Решает, повторять ли запрос после ошибки, и сколько ждать перед повтором
+
+    Задержка растёт экспоненциально с номером попытки и выбирается случайно
+    от 0 до этого значения ("full jitter"), чтобы повторы разных запросов
+    не приходили одновременно.
+    """
+
+    __slots__ = ("rules", "default")
+
+    def __init__(self, rules: Dict[object, RetryRule], default: RetryRule=None):
+        self.rules = rules
+        self.default = default or RetryRule(1)
+
+    def rule(self, code) -> RetryRule:
+        return self.rules.get(code, self.default)
+
+    def should_retry(self, code, attempt: int) -> bool:
+        """attempt - сколько раз запрос уже был отправлен"""
+        return attempt < self.rule(code).attempts
+
+    def delay(self, code, attempt: int) -> float:
+        rule = self.rule(code)
+
+        return random.uniform(0, min(rule.cap, rule.base * 2 ** max(0, attempt - 1)))
+
+
+class CircuitBreaker(object):
+    """Предохранитель: после threshold ошибок подряд запросы перестают отправляться
+
+    В открытом состоянии запросы сразу завершаются с ошибкой. Через reset_timeout
+    секунд предохранитель пропускает один пробный запрос, а остальные отклоняет, пока
+    не придёт его результат: если он успешен - предохранитель закрывается, если нет -
+    снова открывается. Если результат пробного запроса так и не пришёл, через
+    reset_timeout секунд пропускается следующий.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    __slots__ = ("threshold", "reset_timeout", "failures", "opened_at", "state", "probing")
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = 0
+        self.state = self.CLOSED
+
+        # Пробный запрос отправлен, результата ещё нет
+        self.probing = False
+
+    def available(self) -> bool:
+        """Пропустит ли предохранитель запрос сейчас. В отличие от allow, не занимает пробный запрос"""
+        if self.state == self.CLOSED:
+            return True
+
+        # allow отсчитывает время с отправки пробного запроса, так что до его результата
+        # (или до reset_timeout, если результата нет) следующий запрос не пройдёт
+        return time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос. В полуоткрытом состоянии разрешает только пробный запрос"""
+        if self.state == self.CLOSED:
+            return True
+
+        if not self.available():
+            return False
+
+        # Отсчёт до следующей пробы - с момента отправки этой
+        self.state = self.HALF_OPEN
+        self.opened_at = time.monotonic()
+        self.probing = True
+
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.state = self.CLOSED
+        self.probing = False
+
+    def record_failure(self) -> bool:
+        """Учитывает ошибку. Возвращает True, если предохранитель только что открылся"""
+        self.failures += 1
+        self.probing = False
+
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            opened = self.state != self.OPEN
+
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.failures = 0
+
+            return opened
+
+        return False
@@ -32,14 +32,30 @@ PROXIES = (
 # Префиксы сообщений, с помощью которых бот будет понимать, что обращаются к нему.
 PREFIXES = ('!', )
 
+# Сколько аккаунтов авторизовывать одновременно при запуске
+AUTH_CONCURRENCY = 5
+# Сколько секунд ждать авторизации одного аккаунта
+AUTH_TIMEOUT = 60
+
+# Файл, в котором сохраняются токены пользователей, чтобы не входить по паролю при каждом запуске
+# (доступен только владельцу). Пустая строка - не сохранять токены
+TOKEN_STORE = "tokens.json"
+
 # ID приложения, через которое бот будет авторизовываться
 APP_ID = 5982451
 # Максимальные права - https://vk.com/dev/permissions
 SCOPE = 140489887
 
 # Задержка между исполнением команд для одного пользователя. Антифлуд
-# Рекомендуемое значение - 1 секунда
+# Рекомендуемое значение - 1 секунда. 0 - антифлуд выключен
 FLOOD_INTERVAL = 1
+# Сколько сообщений подряд пользователь может отправить без задержки
+FLOOD_BURST = 3
+# То же для всей беседы: не больше FLOOD_PEER_BURST сообщений подряд, дальше - одно раз в FLOOD_PEER_INTERVAL секунд
+FLOOD_PEER_INTERVAL = 0.2
+FLOOD_PEER_BURST = 10
+# Для скольких пользователей и бесед помнить, как часто они пишут
+FLOOD_LIMITER_SIZE = 10000
 # Максимальное количество запросов к VK API за интервал времени, указанный в REQUEST_INTERVAL
 # Целое, положительное число
 REQUESTS_QUANTITY = 3
@@ -47,6 +63,60 @@ REQUESTS_QUANTITY = 3
 # Положительное число
 REQUEST_INTERVAL = 1
 
+# Максимальное количество запросов в очереди одного аккаунта. 0 - без ограничений
+REQUEST_QUEUE_SIZE = 1000
+# Доля заполнения очереди, начиная с которой отбрасываются второстепенные запросы
+# (отметка сообщений прочитанными, повторы одинаковых ответов)
+REQUEST_QUEUE_SHED_LEVEL = 0.8
+
+# Сколько ответов VK API (users.get, groups.getById и т.д.) хранить в кэше
+RESPONSE_CACHE_SIZE = 5000
+
+# Максимальное количество HTTP соединений (всего и к одному серверу)
+HTTP_POOL_LIMIT = 100
+HTTP_POOL_LIMIT_PER_HOST = 30
+# Сколько секунд хранить результаты DNS запросов
+HTTP_DNS_CACHE_TTL = 600
+# Сколько секунд держать открытым неиспользуемое соединение
+HTTP_KEEPALIVE_TIMEOUT = 60
+# Сколько секунд ждать ответа ВК на запрос. Не ответивший вовремя запрос повторяется
+# (запросы Long Poll ждут дольше - на время ожидания событий)
+HTTP_REQUEST_TIMEOUT = 15
+
+# Сколько событий (сообщений) обрабатывать одновременно. События одного диалога обрабатываются по порядку
+EVENT_WORKERS = 50
+# Сколько событий может ждать обработки. Если очередь заполнена, бот перестаёт получать новые события
+EVENT_QUEUE_SIZE = 1000
+
+# Сколько последних сообщений Callback API запоминать и сколько секунд, чтобы не обработать
+# повторно доставленное ВК сообщение ещё раз
+CALLBACK_DEDUP_SIZE = 10000
+CALLBACK_DEDUP_TTL = 600
+
+# Количество процессов, обрабатывающих сообщения. 0 - всё в одном процессе
+# Если больше 0, основной процесс только получает сообщения и распределяет их по процессам
+# (сообщения одного диалога - в один процесс), а лимит запросов аккаунтов общий для всех процессов.
+# Плагины загружаются в каждом процессе, а их периодические задачи выполняет только первый процесс
+WORKER_PROCESSES = 0
+
+# Сколько пользователей хранить в памяти, чтобы не читать их из БД на каждое сообщение
+USER_CACHE_SIZE = 10000
+# True - изменения пользователей (время последнего сообщения и т.п.) записываются в БД пачкой
+# раз в USER_CACHE_FLUSH_INTERVAL секунд и при выключении бота, False - сразу.
+# Бот и плагины в любом случае сразу видят свои изменения
+USER_CACHE_WRITE_BEHIND = True
+USER_CACHE_FLUSH_INTERVAL = 5
+# Через сколько секунд пользователь в памяти перечитывается из БД (0 - не перечитывается).
+# Нужно, если пользователей меняет кто-то ещё, кроме бота. При WORKER_PROCESSES > 0 пользователи
+# всегда перечитываются на каждое сообщение, а изменения записываются сразу
+USER_CACHE_TTL = 0
+
+# Адрес и порт HTTP сервера с метриками бота (http://METRICS_HOST:METRICS_PORT/metrics)
+# 0 - не запускать сервер. При WORKER_PROCESSES > 0 метрики обработки сообщений отдаёт каждый
+# процесс-обработчик на своём порту: METRICS_PORT + 1, METRICS_PORT + 2 и т.д.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9191
+
 
 # Нужно ли обрабатывать исходящие команды (осторожнее с этим!) (не работает для сообщений без команд)
 READ_OUT = False
@@ -21,11 +21,25 @@ PROXIES = list, """Прокси для подключения к VK API с по
 PREFIXES = list, """Префиксы сообщений, с помощью которых бот будет понимать, что обращаются к нему."""
 
 
+AUTH_CONCURRENCY = int, "Сколько аккаунтов авторизовывать одновременно при запуске"
+AUTH_TIMEOUT = int, "Сколько секунд ждать авторизации одного аккаунта"
+
+EVENT_WORKERS = int, "Сколько событий (сообщений) обрабатывать одновременно"
+EVENT_QUEUE_SIZE = int, "Сколько событий может ждать обработки"
+USER_CACHE_SIZE = int, "Сколько пользователей хранить в памяти"
+USER_CACHE_WRITE_BEHIND = bool, "Записывать изменения пользователей в БД пачкой раз в USER_CACHE_FLUSH_INTERVAL секунд"
+USER_CACHE_FLUSH_INTERVAL = int, "Как часто записывать изменения пользователей в БД (в секундах)"
+USER_CACHE_TTL = int, "Через сколько секунд перечитывать пользователя из БД (0 - не перечитывать)"
+WORKER_PROCESSES = int, "Количество процессов, обрабатывающих сообщения. 0 - всё в одном процессе"
+
 APP_ID = int, "ID приложения, через которое бот будет авторизовываться"
 SCOPE = int, "Максимальные права - https://vk.com/dev/permissions"
 
 FLOOD_INTERVAL = int, "Задержка между исполнением команд для одного пользователя. Антифлуд" \
                       "<br>Рекомендуемое значение - 1 секунда"
+FLOOD_BURST = int, "Сколько сообщений подряд пользователь может отправить без задержки"
+FLOOD_PEER_BURST = int, "Сколько сообщений подряд можно отправить в беседе без задержки"
+FLOOD_LIMITER_SIZE = int, "Для скольких пользователей и бесед помнить, как часто они пишут"
 READ_OUT = bool, "Нужно ли обрабатывать исходящие команды  (не работает для сообщений без команд) (осторожнее с этим!)"
 
 
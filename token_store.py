@@ -0,0 +1,98 @@
+# Хранилище токенов пользователей, чтобы не входить в ВК по логину и паролю при каждом запуске
+import hashlib
+import json
+import os
+import time
+from typing import Optional
+
+import hues
+
+try:
+    from settings import TOKEN_STORE
+except ImportError:
+    TOKEN_STORE = "tokens.json"
+
+
+class TokenStore(object):
+    """Файл с токенами и временем их действия
+
+    Файл доступен для чтения и записи только владельцу (права 600). Аккаунты
+    хранятся под хэшем логина, приложения и прав, сам логин в файл не попадает.
+    """
+
+    __slots__ = ("path", "tokens")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tokens = None
+
+    @staticmethod
+    def account_key(username: str, app_id: int, scope: int) -> str:
+        return hashlib.sha256(f"{username}:{app_id}:{scope}".encode()).hexdigest()
+
+    def load(self) -> dict:
+        if self.tokens is not None:
+            return self.tokens
+
+        self.tokens = {}
+
+        if not self.path or not os.path.isfile(self.path):
+            return self.tokens
+
+        try:
+            # Файл мог быть создан вручную или другой программой
+            if os.stat(self.path).st_mode & 0o077:
+                os.chmod(self.path, 0o600)
+
+            with open(self.path, encoding="utf-8") as f:
+                self.tokens = json.load(f)
+
+        except (OSError, ValueError) as e:
+            hues.warn(f"Не удалось прочитать сохранённые токены: {e}")
+
+        return self.tokens
+
+    def write(self) -> None:
+        if not self.path:
+            return
+
+        temp_path = self.path + ".tmp"
+
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+            with open(fd, "w", encoding="utf-8") as f:
+                json.dump(self.tokens, f)
+
+            os.replace(temp_path, self.path)
+
+        except OSError as e:
+            hues.warn(f"Не удалось сохранить токены: {e}")
+
+    def get(self, username: str, app_id: int, scope: int) -> Optional[str]:
+        """Возвращает сохранённый токен, если его срок действия ещё не истёк"""
+        entry = self.load().get(self.account_key(username, app_id, scope))
+
+        if not entry:
+            return None
+
+        if entry["expires"] and entry["expires"] <= time.time():
+            return None
+
+        return entry["token"]
+
+    def save(self, username: str, app_id: int, scope: int, token: str, expires_in: int=0) -> None:
+        """Сохраняет токен. expires_in = 0 - токен бессрочный"""
+        self.load()[self.account_key(username, app_id, scope)] = {
+            "token": token,
+            "expires": time.time() + expires_in if expires_in else 0,
+        }
+
+        self.write()
+
+    def remove(self, username: str, app_id: int, scope: int) -> None:
+        if self.load().pop(self.account_key(username, app_id, scope), None) is not None:
+            self.write()
+
+
+token_store = TokenStore(TOKEN_STORE)
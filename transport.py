@@ -0,0 +1,77 @@
+# Общий HTTP транспорт для всех запросов к ВК
+from typing import Optional
+
+import aiohttp
+
+try:
+    from settings import HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_DNS_CACHE_TTL, HTTP_KEEPALIVE_TIMEOUT
+except ImportError:
+    HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_DNS_CACHE_TTL, HTTP_KEEPALIVE_TIMEOUT = 100, 30, 600, 60
+
+try:
+    from settings import HTTP_REQUEST_TIMEOUT
+except ImportError:
+    HTTP_REQUEST_TIMEOUT = 15
+
+
+def request_timeout(wait: float=0) -> aiohttp.ClientTimeout:
+    """Тайм-аут запроса к ВК: HTTP_REQUEST_TIMEOUT секунд плюс wait секунд, которые сервер
+    может держать запрос намеренно (Long Poll). Зависший запрос завершается asyncio.TimeoutError"""
+    return aiohttp.ClientTimeout(total=HTTP_REQUEST_TIMEOUT + wait)
+
+
+class Transport(object):
+    """Пулы HTTP соединений, общие для всех запросов бота
+
+    Для каждого прокси (и для прямого подключения) создаётся свой пул соединений
+    с keep-alive и кэшем DNS, чтобы не устанавливать TLS соединение заново на каждый запрос.
+    """
+
+    __slots__ = ("connectors", "sessions")
+
+    def __init__(self):
+        self.connectors = {}  # прокси -> aiohttp.TCPConnector
+        self.sessions = {}  # прокси -> aiohttp.ClientSession
+
+    def connector(self, proxy: Optional[str]=None) -> aiohttp.TCPConnector:
+        connector = self.connectors.get(proxy)
+
+        if connector is None or connector.closed:
+            connector = aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT,
+                                             limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                                             use_dns_cache=True,
+                                             ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                                             keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+
+            self.connectors[proxy] = connector
+
+        return connector
+
+    def session(self, proxy: Optional[str]=None) -> aiohttp.ClientSession:
+        """Возвращает общую сессию для запросов через proxy (или напрямую)"""
+        session = self.sessions.get(proxy)
+
+        if session is None or session.closed:
+            session = self.new_session(proxy)
+
+            self.sessions[proxy] = session
+
+        return session
+
+    def new_session(self, proxy: Optional[str]=None, **kwargs) -> aiohttp.ClientSession:
+        """Возвращает новую сессию (со своими cookies) поверх общего пула соединений.
+        Закрыть сессию должен тот, кто её создал."""
+        return aiohttp.ClientSession(connector=self.connector(proxy), connector_owner=False, **kwargs)
+
+    async def close(self) -> None:
+        for session in self.sessions.values():
+            await session.close()
+
+        for connector in self.connectors.values():
+            await connector.close()
+
+        self.sessions.clear()
+        self.connectors.clear()
+
+
+transport = Transport()
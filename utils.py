@@ -1,7 +1,9 @@
 # Various helpers
 import asyncio
+import contextvars
 import datetime
 import html
+import json
 import os
 from configparser import ConfigParser
 from enum import Enum
@@ -39,6 +41,23 @@ class Wait(Enum):
     CUSTOM = 2
 
 
+class BotMode(Enum):
+    SINGLE = 0  # Получение и обработка событий в одном процессе
+    READER = 1  # Получение событий и передача их процессам-обработчикам
+    WORKER = 2  # Обработка событий, полученных от READER
+
+
+class Priority(Enum):
+    """Приоритет запроса к VK API. Чем меньше значение - тем раньше запрос попадёт в execute"""
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+# Приоритет по умолчанию для запросов из текущей задачи (например, Plugin.schedule ставит LOW)
+request_priority = contextvars.ContextVar("request_priority", default=None)
+
+
 class Attachment(object):
     __slots__ = ('type', 'owner_id', 'id', 'access_key', 'url')
 
@@ -76,16 +95,79 @@ class Attachment(object):
 
 
 class RequestFuture(asyncio.Future):
-    __slots__ = ["key", "data", "send_from"]
+    __slots__ = ["key", "data", "send_from", "code", "priority", "queued_at", "attempts"]
 
-    def __init__(self, key, data, send_from=None):
+    def __init__(self, key, data, send_from=None, priority=Priority.NORMAL):
         self.key = key
         self.data = data
         self.send_from = send_from
+        self.priority = priority
+
+        # Время постановки в очередь, используется для защиты от голодания
+        self.queued_at = 0
+
+        # Сколько раз запрос уже отправлялся в составе execute
+        self.attempts = 0
+
+        # Обращение к методу в виде кода VKScript, заполняется при упаковке в execute
+        self.code = None
 
         super().__init__()
 
 
+class TokenBucket(object):
+    """Ограничитель частоты запросов "ведро с токенами"
+
+    Ведро вмещает не более capacity токенов и непрерывно пополняется
+    со скоростью capacity / interval токенов в секунду.
+    """
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: int, interval: float):
+        self.capacity = max(1, capacity)
+        self.rate = self.capacity / interval if interval > 0 else float("inf")
+
+        self.tokens = float(self.capacity)
+        self.updated = None
+
+    def refill(self, now: float) -> None:
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+
+        self.updated = now
+
+    def try_acquire(self, now: float) -> float:
+        """Пробует забрать токен. Возвращает 0, если получилось, иначе - сколько секунд ждать"""
+        self.refill(now)
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self) -> None:
+        """Ждёт, пока в ведре не появится токен, и забирает его"""
+        loop = asyncio.get_event_loop()
+
+        while True:
+            delay = self.try_acquire(loop.time())
+
+            if not delay:
+                return
+
+            await asyncio.sleep(delay)
+
+
+def request_key(key: str, data: dict = None) -> str:
+    """Возвращает ключ запроса к VK API, не зависящий от порядка и типов параметров"""
+    if not data:
+        return key
+
+    return key + json.dumps({k: str(v) for k, v in data.items()}, sort_keys=True, ensure_ascii=False)
+
+
 def schedule_coroutine(target: Coroutine):
     """Schedules target coroutine in the given event loop
     If not given, *loop* defaults to the current thread's event loop
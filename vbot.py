@@ -76,11 +76,18 @@ def check_settings():
 
 check_settings()
 
+import codec
 from utils import *
 from chat.chatter import normalize, ChatterBot
 from command import Command
+from dispatcher import EventDispatcher
+from flood import FloodLimiter
+from migrations import migrate
+from metrics import LONGPOLL_CYCLE_SECONDS, MESSAGES_FLOOD_REJECTED, MESSAGES_HANDLED, registry
 from plugin_system import PluginSystem
+from transport import request_timeout, transport
 from vkplus import *
+from workers import SharedTokenBucket, WorkerPool, WORKER_PROCESSES
 
 
 class Bot(object):
@@ -88,9 +95,11 @@ class Bot(object):
     __slots__ = ["WHITELISTED",
                  "messages_date", "plugin_system", "cmd_system",
                  "last_ts", "scheduled_funcs", "longpoll_server", "longpoll_key",
-                 "chatter", "longpoll_values", "event_loop", "last_message_id", "vk"]
+                 "chatter", "longpoll_values", "event_loop", "last_message_id", "vk", "dispatcher", "flood"]
 
-    def __init__(self):
+    def __init__(self, mode: BotMode=BotMode.SINGLE, buckets: list=None):
+        """mode - какую часть работы выполняет этот процесс (см. BotMode),
+        buckets - общие для процессов ограничители частоты запросов аккаунтов из settings.USERS"""
         self.WHITELISTED = False
 
         self.longpoll_values = {}
@@ -98,9 +107,23 @@ class Bot(object):
         self.longpoll_key = ""
         self.last_ts = 0
 
-        self.vk_init()
+        self.flood = FloodLimiter()
 
-        if sys.argv and "-nu" in sys.argv:
+        if mode == BotMode.READER:
+            # Лимит запросов каждого аккаунта - общий для всех процессов
+            buckets = [SharedTokenBucket(settings.REQUESTS_QUANTITY, settings.REQUEST_INTERVAL)
+                       for _ in settings.USERS]
+
+            # События обрабатываются в процессах-обработчиках
+            self.dispatcher = WorkerPool(WORKER_PROCESSES, buckets)
+
+        else:
+            # Очередь событий и обработчики, которые из неё берут события
+            self.dispatcher = EventDispatcher(self.check_event)
+
+        self.vk_init(buckets)
+
+        if mode != BotMode.WORKER and sys.argv and "-nu" in sys.argv:
             self.plugin_download(f"https://vkbots.github.io/vbot-plugins")
             self.plugin_clear()
 
@@ -108,6 +131,9 @@ class Bot(object):
                 hues.success("Плагины обновлены")
                 exit()
 
+        if mode == BotMode.READER:
+            return
+
         self.plugin_init()
 
         if settings.CHAT_ENABLE:
@@ -117,7 +143,7 @@ class Bot(object):
                 from chat.chat import chatter
                 self.chatter = chatter
 
-    def vk_init(self):
+    def vk_init(self, buckets: list=None):
         hues.warn("Авторизация в ВКонтакте...")
 
         self.messages_date = {}  # Словарь вида ID -> время
@@ -126,7 +152,8 @@ class Bot(object):
                          proxies=settings.PROXIES,
                          bot=self,
                          scope=settings.SCOPE,
-                         app_id=settings.APP_ID)
+                         app_id=settings.APP_ID,
+                         buckets=buckets)
         if self.vk:
             hues.success("Успешная авторизация")
 
@@ -239,8 +266,11 @@ class Bot(object):
     async def get_long_poll_server(retries: int, vk: VkPlus) -> dict:
         result = ""
 
+        # Сообщения из бесед получает основной аккаунт, поэтому Long Poll всегда от его имени
+        sender = vk.get_default_sender('messages.getLongPollServer', target=0)
+
         for x in range(retries):
-            result = await vk.method('messages.getLongPollServer', {'use_ssl': 1})
+            result = await vk.method('messages.getLongPollServer', {'use_ssl': 1}, send_from=sender)
 
             if result:
                 break
@@ -270,7 +300,10 @@ class Bot(object):
 
         if update == 0:
             # Если нам нужно инициализировать с нуля, меняем сервер
-            self.longpoll_server = "https://" + result['server']
+            self.longpoll_server = result['server']
+
+            if "://" not in self.longpoll_server:
+                self.longpoll_server = "https://" + self.longpoll_server
 
         if update in (0, 3):
             # Если нам нужно инициализировать с нуля, или ошибка 3
@@ -321,16 +354,23 @@ class Bot(object):
 
         user_id = int(user_id)
 
+        # Антифлуд - до любых запросов к БД и плагинам
+        if not flags['outbox']:
+            limit = self.flood.check(user_id, peer_id if conf else None)
+
+            if limit:
+                MESSAGES_FLOOD_REJECTED.inc(limit)
+                return
+
         # Если ID находится в чёрном списке
-        if await get_or_none(Role, user_id=user_id, role="blacklisted") or \
-                await get_or_none(Role, user_id=peer_id, role="blacklisted"):
+        if role_index.has(user_id, "blacklisted") or role_index.has(peer_id, "blacklisted"):
             if settings.BLACKLIST_MESSAGE:
                 await self.vk.method("messages.send", {"user_id": peer_id, "message": settings.BLACKLIST_MESSAGE})
 
             return
 
         # Если ID моет писать боту или белый список отключён
-        if self.WHITELISTED and not await get_or_none(Role, user_id=peer_id, role="whitelisted"):
+        if self.WHITELISTED and not role_index.has(peer_id, "whitelisted"):
             if settings.WHITELIST_MESSAGE:
                 await self.vk.method("messages.send", {"user_id": peer_id, "message": settings.WHITELIST_MESSAGE})
 
@@ -346,20 +386,7 @@ class Bot(object):
 
         data = MessageEventData(conf, peer_id, user_id, cleaned_body, ts, msg_id, flags['outbox'], attaches, forwarded)
 
-        user = await get_or_none(User, user_id=user_id)
-        if user:
-            if not flags['outbox']:
-                if ts - user.message_date <= settings.FLOOD_INTERVAL:
-                    user.message_date = ts
-                    await db.update(user)
-                    return
-
-                user.message_date = ts
-
-                await db.update(user)
-
-        else:
-            user = await db.create(User, user_id=user_id)
+        user, _ = await user_cache.get_or_create(user_id)
 
         # Обработка команды
         await self.check_if_command(data, user)
@@ -383,7 +410,7 @@ class Bot(object):
 
             user.chat_data = json.dumps(chat_data)
 
-            await db.update(user)
+            await user_cache.save(user, "chat_data")
 
             await msg.answer(answer)
 
@@ -404,6 +431,8 @@ class Bot(object):
         return result
 
     async def check_if_command(self, data: MessageEventData, user: User) -> None:
+        MESSAGES_HANDLED.inc()
+
         if settings.LOG_MESSAGES:
             who = f"{'конференции' if data.conf else 'ЛС'} {data.peer_id}"
             hues.info(f"Сообщение из {who} > {data.body}")
@@ -442,51 +471,59 @@ class Bot(object):
 
         await self.init_long_polling()
 
-        with aiohttp.ClientSession(loop=event_loop) as session:
-            while True:
-                try:
-                    resp = await session.get(self.longpoll_server,
-                                             params=self.longpoll_values)
-                except (aiohttp.ClientOSError, asyncio.TimeoutError):
-                    hues.warn('Сервер Long Polling не отвечает, подключаюсь к другому...')
-                    await self.init_long_polling()
-                    continue
+        self.dispatcher.start()
+
+        session = transport.session()
+
+        while True:
+            try:
+                with LONGPOLL_CYCLE_SECONDS.time():
+                    resp = await session.get(self.longpoll_server, params=self.longpoll_values,
+                                             timeout=request_timeout(self.longpoll_values['wait']))
 
-                events_text = await resp.text()  # text(), а не json() из-за плохого mimetype у вк
+                    events_data = await resp.read()  # read(), а не json() из-за плохого mimetype у вк
+            except (aiohttp.ClientOSError, asyncio.TimeoutError):
+                hues.warn('Сервер Long Polling не отвечает, подключаюсь к другому...')
+                await self.init_long_polling()
+                continue
 
-                try:
-                    events = json.loads(events_text)
-                except ValueError:
-                    continue
+            try:
+                events = codec.loads(events_data)
+            except ValueError:
+                continue
 
-                failed = events.get('failed')
-                if failed:
-                    err_num = int(failed)
+            failed = events.get('failed')
+            if failed:
+                err_num = int(failed)
 
-                    if err_num == 1:  # Код 1 - Нам нужно обновить timestamp
-                        self.longpoll_values['ts'] = events['ts']
+                if err_num == 1:  # Код 1 - Нам нужно обновить timestamp
+                    self.longpoll_values['ts'] = events['ts']
 
-                    elif err_num in (2, 3):  # Коды 2 и 3 - нужно запросить данные нового Long Polling сервера
-                        await self.init_long_polling(err_num)
+                elif err_num in (2, 3):  # Коды 2 и 3 - нужно запросить данные нового Long Polling сервера
+                    await self.init_long_polling(err_num)
 
-                    continue
+                continue
 
-                # Обновление времени, чтобы не приходили старые события
-                self.longpoll_values['ts'] = events['ts']
+            # Обновление времени, чтобы не приходили старые события
+            self.longpoll_values['ts'] = events['ts']
 
-                # Обработка сообщений
-                for event in events['updates']:
-                    schedule_coroutine(self.check_event(event))
+            # Обработка сообщений. Если очередь событий заполнена - ждём, пока она освободится
+            for event in events['updates']:
+                await self.dispatcher.put(event)
 
 VERSION = "6.0"
 
 if __name__ == '__main__':
     hues.info("Приступаю к запуску VBot " + VERSION)
 
-    bot = Bot()
+    migrate()
+
+    # WORKER_PROCESSES > 0 - этот процесс только получает события, а обрабатывают их отдельные процессы
+    bot = Bot(BotMode.READER if WORKER_PROCESSES > 0 else BotMode.SINGLE)
 
     main_loop = asyncio.get_event_loop()
     main_loop.run_until_complete(set_up_roles(bot))
+    main_loop.run_until_complete(registry.start_server())
 
     hues.success("Приступаю к приему сообщений")
 
@@ -500,3 +537,9 @@ if __name__ == '__main__':
 
         logging.warning("Fatal error:\n")
         traceback.print_exc()
+
+    finally:
+        main_loop.run_until_complete(bot.dispatcher.stop())
+        main_loop.run_until_complete(user_cache.close())
+        main_loop.run_until_complete(registry.stop_server())
+        main_loop.run_until_complete(transport.close())
@@ -4,26 +4,92 @@ from os import getenv
 
 from aiohttp import web, asyncio
 
+import codec
+from cache import MISSING, TTLCache
 from database import *
+from dispatcher import EventDispatcher
+from metrics import CALLBACK_DEDUP_HIT_RATE, EVENTS_DUPLICATE, EVENTS_REJECTED, registry
+from migrations import migrate
 from vbot import Bot
 from vkplus import MessageEventData
 
+try:
+    from settings import CALLBACK_DEDUP_SIZE, CALLBACK_DEDUP_TTL
+except ImportError:
+    CALLBACK_DEDUP_SIZE, CALLBACK_DEDUP_TTL = 10000, 600
+
 
 class CallbackBot(Bot):
     CONF_CODE = ""  # Введите код подтверждения тут
 
+    def __init__(self):
+        super().__init__()
+
+        # ВК ждёт ответ на запрос не больше нескольких секунд, поэтому события обрабатываются после ответа
+        self.dispatcher = EventDispatcher(self.process_event)
+
+        # Недавно принятые сообщения. Если ВК не дождался ответа, он присылает событие повторно
+        self.seen = TTLCache(CALLBACK_DEDUP_SIZE)
+        CALLBACK_DEDUP_HIT_RATE.track(lambda: self.seen.hit_rate)
+
+    @staticmethod
+    def event_key(data: dict):
+        """Ключ события для поиска повторов. None - событие не нужно проверять"""
+        if data['type'] not in ('message_new', 'message_reply'):
+            # Вступление и выход из группы можно обработать повторно без последствий
+            return None
+
+        message_id = data['object'].get('id')
+
+        if message_id is None:
+            return None
+
+        return data.get('group_id'), data['type'], message_id
+
     async def process_callback(self, request):
-        """Функция для обработки запроса от VK Callback API группы"""
+        """Функция для обработки запроса от VK Callback API группы
+
+        Событие проверяется и ставится в очередь, а ВК сразу получает ответ "ok".
+        Если очередь заполнена - отвечаем ошибкой, чтобы ВК прислал событие позже.
+        """
         try:
-            data = await request.json()
+            data = codec.loads(await request.read())
         except Exception:
             # Почти невозможно, что будет эта ошибка
             return web.Response(text="ok")
 
-        type = data['type']
-        if type == 'confirmation':
+        if not isinstance(data, dict) or 'type' not in data:
+            return web.Response(text="ok")
+
+        if data['type'] == 'confirmation':
             # Нам нужно подтвердить наш сервер
             return web.Response(text=self.CONF_CODE)
+
+        if data['type'] not in ('message_new', 'message_reply', 'group_join', 'group_leave') or \
+                not isinstance(data.get('object'), dict):
+            return web.Response(text="ok")
+
+        key = self.event_key(data)
+
+        if key is not None and self.seen.get(key) is not MISSING:
+            # Повторная доставка уже принятого события
+            EVENTS_DUPLICATE.inc()
+
+            return web.Response(text="ok")
+
+        if not self.dispatcher.put_nowait(data):
+            EVENTS_REJECTED.inc()
+
+            return web.Response(status=503, text="busy")
+
+        if key is not None:
+            self.seen.set(key, True, CALLBACK_DEDUP_TTL)
+
+        return web.Response(text='ok')
+
+    async def process_event(self, data):
+        """Обработка события Callback API, взятого из очереди"""
+        type = data['type']
         obj = data['object']
 
         if type in ('message_new', 'message_reply'):
@@ -31,38 +97,52 @@ class CallbackBot(Bot):
 
             data = MessageEventData.from_message_body(obj)
 
-            user, create = await db.get_or_create(User, user_id=user_id)
+            user, create = await user_cache.get_or_create(user_id)
 
             await self.check_if_command(data, user)
+
         if type == 'group_join':
             # Человек присоединился к группе
             user_id = int(obj['user_id'])
 
-            user, create = await db.get_or_create(user_id=user_id)
+            user, create = await user_cache.get_or_create(user_id)
 
             user.in_group = True
 
-            await db.update(user)
+            await user_cache.save(user, "in_group")
 
         if type == 'group_leave':
             # Человек вышел из группы
             user_id = int(obj['user_id'])
 
-            user, create = await db.get_or_create(user_id=user_id)
+            user, create = await user_cache.get_or_create(user_id)
 
             user.in_group = False
 
-            await db.update(user)
-
-        return web.Response(text='ok')
+            await user_cache.save(user, "in_group")
 
 
 if __name__ == '__main__':
+    migrate()
+
     loop = asyncio.get_event_loop()
     bot = CallbackBot()
     app = web.Application(loop=loop)
     app.router.add_post('/', bot.process_callback)
 
+    async def start(app):
+        bot.dispatcher.start()
+
+        await registry.start_server()
+
+    async def stop(app):
+        await bot.dispatcher.stop()
+        await user_cache.close()
+        await registry.stop_server()
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+
     hues.success("Приступаю к приему сообщений")
 
     try:
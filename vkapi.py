@@ -1,27 +1,276 @@
 import asyncio
-import json
 import re
+import time
+from collections import deque
+from itertools import count
 from urllib.parse import urlparse, parse_qsl
 
 import aiohttp
 import hues
 
+import codec
 import settings
 import vkplus
-from utils import fatal, schedule_coroutine
+from metrics import VK_CALL_ERRORS, VK_CALL_SECONDS, VK_EXECUTE_BATCH_SIZE, VK_EXECUTE_CODE_BYTES, \
+    VK_EXECUTE_FILL_RATIO, VK_EXECUTE_SECONDS, VK_QUEUE_DELAYED, VK_QUEUE_DEPTH, VK_QUEUE_DROPPED
+from retry import CircuitBreaker, RetryPolicy, RetryRule
+from token_store import token_store
+from transport import request_timeout, transport
+from utils import fatal, schedule_coroutine, Priority, TokenBucket
+from vkscript import EXECUTE_PREFIX, EXECUTE_SUFFIX, render_batch, render_call
+
+try:
+    from settings import REQUEST_QUEUE_SIZE, REQUEST_QUEUE_SHED_LEVEL
+except ImportError:
+    REQUEST_QUEUE_SIZE, REQUEST_QUEUE_SHED_LEVEL = 1000, 0.8
+
+API_URL = "https://api.vk.com/method/"
+API_VERSION = "5.64"
 
 AUTHORIZATION_FAILED = 5
+TOO_MANY_REQUESTS = 6
+FLOOD_CONTROL = 9
+INTERNAL_ERROR = 10
 CAPTCHA_IS_NEEDED = 14
 ACCESS_DENIED = 15
-INTERNAL_ERROR = 10
+
+# Код ошибки для случаев, когда ВК не ответил (таймаут, обрыв соединения, битый ответ)
+NO_RESPONSE = None
+
+# Сколько раз отправлять запрос при разных ошибках и как долго ждать между попытками
+RETRY_POLICY = RetryPolicy({
+    NO_RESPONSE: RetryRule(attempts=4, base=1, cap=10),
+    1: RetryRule(attempts=3, base=1, cap=5),  # Неизвестная ошибка
+    AUTHORIZATION_FAILED: RetryRule(attempts=2, base=0, cap=0),  # Повтор после переполучения токена
+    TOO_MANY_REQUESTS: RetryRule(attempts=5, base=0.5, cap=5),
+    FLOOD_CONTROL: RetryRule(attempts=1),  # Повтор только усилит флуд-контроль
+    INTERNAL_ERROR: RetryRule(attempts=4, base=1, cap=10),
+    CAPTCHA_IS_NEEDED: RetryRule(attempts=3, base=0, cap=0),  # Повтор с решённой капчей
+})
+
+# Ошибки, которые говорят о недоступности ВК и учитываются предохранителем
+SERVICE_ERRORS = (NO_RESPONSE, INTERNAL_ERROR)
+
+# После стольких неудачных запросов подряд клиент перестаёт отправлять запросы
+# и исключается из ротации, а ожидающие запросы сразу завершаются с ошибкой
+CLIENT_MAX_FAILURES = 3
+# Через сколько секунд клиент попробует отправить запрос снова
+CLIENT_SUSPEND_TIME = 30
+
+# Ошибки аккаунта (а не ВК): если запросы аккаунта CLIENT_MAX_ACCOUNT_ERRORS раз за
+# CLIENT_ACCOUNT_ERRORS_WINDOW секунд завершились такой ошибкой (токен не удалось переполучить,
+# капчу не удалось решить), аккаунт на CLIENT_ACCOUNT_SUSPEND_TIME секунд исключается из ротации.
+# Запросы, закреплённые за аккаунтом, он при этом выполняет
+ACCOUNT_ERRORS = (AUTHORIZATION_FAILED, CAPTCHA_IS_NEEDED)
+CLIENT_MAX_ACCOUNT_ERRORS = 3
+CLIENT_ACCOUNT_ERRORS_WINDOW = 60
+CLIENT_ACCOUNT_SUSPEND_TIME = 300
+
+
+class VkApiError(Exception):
+    """Ошибка VK API при выполнении метода"""
+
+    def __init__(self, code, message: str, method: str = None, error: dict = None):
+        self.code = code
+        self.message = message
+        self.method = method
+
+        # Исходное описание ошибки от ВК (например, с данными капчи)
+        self.error = error or {}
+
+        super().__init__(f"[{code}] {method}: {message}")
+
+    @staticmethod
+    def from_error(error: dict, method: str = None) -> 'VkApiError':
+        """Создаёт исключение из описания ошибки ВК (поле error или элемент execute_errors)"""
+        if not error:
+            return VkApiError(1, "Неизвестная ошибка", method)
+
+        return VkApiError(error.get('error_code'), error.get('error_msg', ''), error.get('method', method), error)
+
+
+class CircuitOpen(VkApiError):
+    """ВК не отвечает, запросы временно не отправляются"""
+
+    def __init__(self, method: str = None):
+        super().__init__(NO_RESPONSE, "ВК не отвечает, запрос не отправлялся", method)
+
+
+# Ограничения execute: не более 25 обращений к API и ограниченный размер кода
+EXECUTE_MAX_CALLS = 25
+EXECUTE_MAX_CODE_SIZE = 60000
+
+# Сколько секунд запрос может ждать в очереди своего приоритета, пока его не
+# пропустят вперёд запросов с более высоким приоритетом
+LANE_MAX_WAIT = {
+    Priority.HIGH: None,
+    Priority.NORMAL: 2,
+    Priority.LOW: 5,
+}
+
+
+class RequestDropped(Exception):
+    """Запрос отброшен, т.к. очередь запросов переполнена"""
+
+    def __init__(self, method: str):
+        self.method = method
+
+        super().__init__(f"Запрос {method} отброшен: очередь запросов переполнена")
+
+
+class RequestQueue(object):
+    """Очередь запросов к VK API с полосами разных приоритетов
+
+    Запросы выдаются из полосы с наивысшим приоритетом. Чтобы полосы с низким
+    приоритетом не голодали, запрос, прождавший дольше LANE_MAX_WAIT своей полосы,
+    выдаётся вне очереди.
+
+    Размер очереди ограничен maxsize: при переполнении put ждёт освобождения места.
+    Когда очередь заполнена больше чем на shed_level, запросы с низким приоритетом
+    и повторы уже ожидающих отправки сообщений отбрасываются.
+    """
+
+    __slots__ = ("lanes", "event", "not_full", "maxsize", "shed_level", "replies",
+                 "dropped", "delayed")
+
+    def __init__(self, maxsize: int=0, shed_level: float=1.0):
+        self.lanes = {priority: deque() for priority in Priority}
+        self.event = asyncio.Event()
+
+        self.maxsize = maxsize
+        self.shed_level = shed_level
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+        # Ключи ожидающих отправки сообщений -> их количество в очереди
+        self.replies = {}
+
+        # Сколько запросов отброшено и сколько ждали места в очереди
+        self.dropped = 0
+        self.delayed = 0
+
+    def qsize(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def empty(self) -> bool:
+        return not any(self.lanes.values())
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self.qsize()
+
+    @staticmethod
+    def reply_key(task):
+        if task.key != 'messages.send' or not task.data:
+            return None
+
+        data = task.data
+
+        return (data.get('peer_id'), data.get('user_id'), data.get('chat_id'),
+                str(data.get('message')), str(data.get('attachment')))
+
+    def track(self, task, delta: int) -> None:
+        key = self.reply_key(task)
+
+        if key is None:
+            return
+
+        count = self.replies.get(key, 0) + delta
+
+        if count > 0:
+            self.replies[key] = count
+        else:
+            self.replies.pop(key, None)
+
+    def should_shed(self, task) -> bool:
+        if not self.maxsize or self.qsize() < self.maxsize * self.shed_level:
+            return False
+
+        if task.priority == Priority.LOW:
+            return True
+
+        key = self.reply_key(task)
+
+        return key is not None and key in self.replies
+
+    async def put(self, task) -> bool:
+        """Добавляет запрос в очередь, дождавшись свободного места.
+        Возвращает False, если запрос был отброшен."""
+        if self.should_shed(task):
+            self.dropped += 1
+            return False
+
+        if self.full():
+            self.delayed += 1
+
+            while self.full():
+                self.not_full.clear()
+                await self.not_full.wait()
+
+        self.put_nowait(task)
+
+        return True
+
+    def put_nowait(self, task) -> None:
+        task.queued_at = asyncio.get_event_loop().time()
+
+        self.lanes[task.priority].append(task)
+        self.track(task, 1)
+        self.event.set()
+
+    def requeue(self, task) -> None:
+        """Возвращает запрос в начало его полосы (даже если очередь заполнена)"""
+        self.lanes[task.priority].appendleft(task)
+        self.track(task, 1)
+        self.event.set()
+
+    async def wait(self) -> None:
+        """Ждёт, пока в очереди не появится хотя бы один запрос"""
+        while self.empty():
+            self.event.clear()
+            await self.event.wait()
+
+    async def get(self):
+        await self.wait()
+
+        return self.get_nowait()
+
+    def get_nowait(self):
+        if self.empty():
+            raise asyncio.QueueEmpty
+
+        task = self.pop()
+
+        self.track(task, -1)
+
+        if not self.full():
+            self.not_full.set()
+
+        return task
+
+    def pop(self):
+        now = asyncio.get_event_loop().time()
+
+        for priority, lane in self.lanes.items():
+            max_wait = LANE_MAX_WAIT[priority]
+
+            if lane and max_wait is not None and now - lane[0].queued_at > max_wait:
+                return lane.popleft()
+
+        for lane in self.lanes.values():
+            if lane:
+                return lane.popleft()
 
 
 class VkClient:
-    __slots__ = ("token", "session", "req_kwargs", "retry",
+    # Номера клиентов для метрик
+    numbers = count()
+
+    __slots__ = ("number", "token", "session", "req_kwargs", "auth_lock",
                  "username", "password", "app_id", "scope",
-                 "queue", "requests")
+                 "queue", "bucket", "in_flight", "breaker", "account_errors", "suspended_until", "dispatcher",
+                 "batches", "batched_calls", "batched_size")
 
-    def __init__(self, proxy: list = None):
+    def __init__(self, proxy: list = None, bucket: TokenBucket = None):
         self.req_kwargs = {}
         if proxy:
             url, username, password, encoding = *proxy, None, None, None
@@ -33,10 +282,33 @@ class VkClient:
                                                                   password if password else "",
                                                                   encoding if encoding else "latin1")
 
-        self.session = aiohttp.ClientSession()
+        # Запросы через один прокси используют общий пул соединений
+        self.session = transport.session(self.req_kwargs.get("proxy"))
+
+        self.number = str(next(VkClient.numbers))
+
+        self.queue = RequestQueue(REQUEST_QUEUE_SIZE, REQUEST_QUEUE_SHED_LEVEL)
+        VK_QUEUE_DEPTH.track(self.queue.qsize, self.number)
+        self.bucket = bucket or TokenBucket(settings.REQUESTS_QUANTITY, settings.REQUEST_INTERVAL)
+
+        # Запросы в отправленных, но ещё не выполненных execute
+        self.in_flight = 0
+
+        self.breaker = CircuitBreaker(CLIENT_MAX_FAILURES, CLIENT_SUSPEND_TIME)
+
+        # Время последних ошибок аккаунта и до какого времени аккаунт исключён из ротации
+        self.account_errors = deque(maxlen=CLIENT_MAX_ACCOUNT_ERRORS)
+        self.suspended_until = 0
+
+        # Статистика заполнения execute
+        self.batches = 0
+        self.batched_calls = 0
+        self.batched_size = 0
 
-        self.queue = asyncio.Queue()
-        self.requests = 0
+        VK_QUEUE_DROPPED.track(lambda: self.queue.dropped, self.number)
+        VK_QUEUE_DELAYED.track(lambda: self.queue.delayed, self.number)
+        VK_EXECUTE_FILL_RATIO.track(lambda: self.fill_ratio, self.number)
+        VK_EXECUTE_CODE_BYTES.track(lambda: self.batched_size, self.number)
 
         self.username = ""
         self.password = ""
@@ -44,149 +316,365 @@ class VkClient:
         self.scope = -1
 
         self.token = ""
+        self.auth_lock = asyncio.Lock()
 
-        self.retry = 0
+        self.dispatcher = schedule_coroutine(self.process_queue())
 
-        schedule_coroutine(self.update_requests())
-        schedule_coroutine(self.process_queue())
+    def close(self):
+        """Останавливает обработку очереди запросов"""
+        self.dispatcher.cancel()
 
-    async def update_requests(self):
-        while True:
-            if self.requests > 0:
-                await asyncio.sleep(settings.REQUEST_INTERVAL)
-                self.requests = 0
+        for metric in (VK_QUEUE_DEPTH, VK_QUEUE_DROPPED, VK_QUEUE_DELAYED, VK_EXECUTE_FILL_RATIO, VK_EXECUTE_CODE_BYTES):
+            metric.remove(self.number)
+
+    @property
+    def fill_ratio(self) -> float:
+        """Средняя заполненность execute (по количеству обращений к API)"""
+        if not self.batches:
+            return 0.0
+
+        return self.batched_calls / (self.batches * EXECUTE_MAX_CALLS)
+
+    @property
+    def load(self) -> float:
+        """Нагрузка на клиент: запросы в очереди и в пути плюс исчерпанная часть лимита запросов"""
+        self.bucket.refill(asyncio.get_event_loop().time())
+
+        return self.queue.qsize() + self.in_flight + (self.bucket.capacity - self.bucket.tokens)
+
+    def healthy(self) -> bool:
+        return self.breaker.available() and time.monotonic() >= self.suspended_until
+
+    def report_success(self) -> None:
+        self.breaker.record_success()
+
+    def report_failure(self, error: VkApiError) -> None:
+        if error.code not in SERVICE_ERRORS:
+            # ВК ответил - значит, он работает
+            self.breaker.record_success()
+            return
+
+        if self.breaker.record_failure():
+            hues.warn(f"ВК не отвечает, аккаунт не будет отправлять запросы {CLIENT_SUSPEND_TIME} сек.")
+
+    def report_account_failure(self, error: VkApiError) -> None:
+        """Учитывает запрос, окончательно завершившийся ошибкой аккаунта"""
+        if error.code not in ACCOUNT_ERRORS:
+            return
+
+        now = time.monotonic()
 
-            await asyncio.sleep(0.1)
+        self.account_errors.append(now)
+
+        if len(self.account_errors) < CLIENT_MAX_ACCOUNT_ERRORS or \
+                now - self.account_errors[0] > CLIENT_ACCOUNT_ERRORS_WINDOW:
+            return
+
+        self.account_errors.clear()
+        self.suspended_until = now + CLIENT_ACCOUNT_SUSPEND_TIME
+
+        hues.warn(f"Аккаунт исключён из ротации на {CLIENT_ACCOUNT_SUSPEND_TIME} сек. из-за ошибок: {error}")
 
     async def process_queue(self):
+        """Отправляет запросы из очереди, как только они появляются и позволяет лимит запросов"""
         while True:
             try:
-                if self.queue.empty() or self.requests >= settings.REQUESTS_QUANTITY:
-                    await asyncio.sleep(0.1)
+                await self.queue.wait()
+
+                if not self.breaker.allow():
+                    self.reject_queue()
                     continue
 
-                await self.execute_queue()
+                # Пока ждём разрешения на запрос, в очереди копятся запросы для этого же execute
+                await self.bucket.acquire()
+
+                tasks, execute = self.collect_batch()
+
+                schedule_coroutine(self.execute_queue(tasks, execute))
 
             except Exception as e:
                 import traceback
                 hues.error("Ошибка во время обработки запросов к ВК")
                 traceback.print_exc()
 
-    async def execute_queue(self):
-        execute = "return ["
+    def reject_queue(self):
+        """Завершает все ожидающие запросы ошибкой, пока ВК не отвечает"""
+        while not self.queue.empty():
+            task = self.queue.get_nowait()
+
+            if not task.done():
+                task.set_exception(CircuitOpen(task.key))
 
+                VK_CALL_ERRORS.inc(task.key, str(NO_RESPONSE))
+
+    def collect_batch(self):
+        """Собирает запросы для одного execute
+
+        Запросы берутся из очереди по приоритету, пока не кончатся места под обращения к API
+        или размер кода. Не поместившиеся запросы возвращаются в начало очереди до следующего
+        execute, а запрос, который больше лимита сам по себе, отправляется отдельным execute.
+        """
         tasks = []
+        calls = []
+        skipped = []
+
+        size = len(EXECUTE_PREFIX) + len(EXECUTE_SUFFIX)
+
+        while len(tasks) < EXECUTE_MAX_CALLS and len(skipped) < EXECUTE_MAX_CALLS:
+            if self.queue.empty():
+                break
 
-        for i in range(25):
             task = self.queue.get_nowait()
 
-            if task.data is None:
-                task.data = {}
+            if task.code is None:
+                task.code = render_call(task.key, task.data)
+
+            # +1 на запятую между обращениями
+            task_size = len(task.code.encode()) + 1
 
-            execute += 'API.' + task.key + '({'
-            execute += ", ".join((f"{k}: \"" + str(v).replace('"', '\\"') + "\"") for k, v in task.data.items())
-            execute += '}), '
+            if tasks and size + task_size > EXECUTE_MAX_CODE_SIZE:
+                skipped.append(task)
+                continue
 
             tasks.append(task)
+            calls.append(task.code)
+            size += task_size
 
-            if self.queue.empty():
-                break
+        for task in reversed(skipped):
+            self.queue.requeue(task)
+
+        self.batches += 1
+        self.batched_calls += len(tasks)
+        self.batched_size += size
 
-        execute += "];"
+        return tasks, render_batch(calls)
+
+    async def execute_queue(self, tasks, execute, attempt=1, **additional_values):
+        self.in_flight += len(tasks)
+
+        VK_EXECUTE_BATCH_SIZE.observe(len(tasks))
 
         try:
-            self.requests += 1
-            result = await asyncio.shield(self.execute(execute))
+            data = await asyncio.shield(self._execute(execute, **additional_values))
 
-        except (asyncio.TimeoutError, json.decoder.JSONDecodeError):
-            self.requests += 1
-            result = await asyncio.shield(self.execute(execute))
+        except VkApiError as e:
+            self.report_failure(e)
 
-        for task in tasks:
-            try:
-                if result:
-                    task_result = result.pop(0)
-                    task.set_result(task_result)
+            if e.code != CAPTCHA_IS_NEEDED:
+                if e.code == AUTHORIZATION_FAILED:
+                    await self.relogin()
+
+                # Ошибка всего execute - повторяем все запросы, если это имеет смысл.
+                # Повтор безопасен: messages.send отправляется с random_id
+                for task in tasks:
+                    self.retry_or_fail(task, e)
+
+                return
+
+            # Капча на весь execute - отправляем все запросы снова с решённой капчей
+            captcha_tasks, captcha_error = tasks, e
+
+        else:
+            self.report_success()
+
+            captcha_tasks, captcha_error = self.dispatch_results(tasks, data)
+
+        finally:
+            self.in_flight -= len(tasks)
+
+        if captcha_tasks:
+            await self.resend_with_captcha(captcha_tasks, captcha_error, attempt)
+
+    async def resend_with_captcha(self, tasks, error: VkApiError, attempt: int):
+        """Решает капчу и отправляет запросы ещё раз одним execute с captcha_sid и captcha_key"""
+        tasks = [task for task in tasks if not task.done()]
+
+        if not tasks:
+            return
+
+        captcha_key = None
+
+        if RETRY_POLICY.should_retry(CAPTCHA_IS_NEEDED, attempt) and error.error.get("captcha_img"):
+            captcha_key = await vkplus.enter_captcha(error.error["captcha_img"])
+
+        if not captcha_key:
+            for task in tasks:
+                self.retry_or_fail(task, error)
+
+            return
+
+        await self.bucket.acquire()
+
+        await self.execute_queue(tasks, render_batch([task.code for task in tasks]), attempt + 1,
+                                 captcha_sid=error.error["captcha_sid"], captcha_key=captcha_key)
+
+    def dispatch_results(self, tasks, data):
+        """Раздаёт результаты execute запросам, а ошибки из execute_errors - запросам, которые не выполнились
+
+        Запросы, которым ВК ответил капчей, не завершаются, а возвращаются вместе с ошибкой капчи.
+        """
+        captcha_tasks = []
+        captcha_error = None
+
+        results = data.get('response')
+
+        if not isinstance(results, list):
+            results = []
+
+        execute_errors = iter(data.get('execute_errors') or ())
+
+        now = asyncio.get_event_loop().time()
+
+        for i, task in enumerate(tasks):
+            if task.done():
+                continue
+
+            if i >= len(results):
+                self.retry_or_fail(task, VkApiError(NO_RESPONSE, "Пустой ответ от ВК", task.key))
+                continue
+
+            result = results[i]
+
+            if result is False:
+                error = VkApiError.from_error(next(execute_errors, None), task.key)
+
+                if error.code == CAPTCHA_IS_NEEDED:
+                    captcha_tasks.append(task)
+                    captcha_error = error
                 else:
-                    task.set_result(None)
+                    self.retry_or_fail(task, error)
+
+                continue
+
+            task.set_result(result)
+
+            VK_CALL_SECONDS.observe(now - task.queued_at, task.key)
+
+        return captcha_tasks, captcha_error
+
+    def retry_or_fail(self, task, error: VkApiError):
+        """Возвращает запрос в очередь после паузы, если ошибку можно переждать, иначе завершает его с ошибкой
+
+        Пауза отсчитывается для каждого запроса отдельно и не задерживает остальную очередь.
+        """
+        if task.done():
+            return
+
+        task.attempts += 1
+
+        # Капчу решает resend_with_captcha: сюда она попадает, только если решить её не удалось
+        if error.code == CAPTCHA_IS_NEEDED or not RETRY_POLICY.should_retry(error.code, task.attempts):
+            task.set_exception(error)
+
+            self.report_account_failure(error)
+
+            VK_CALL_ERRORS.inc(task.key, str(error.code))
+            return
+
+        delay = RETRY_POLICY.delay(error.code, task.attempts)
 
-            except (asyncio.InvalidStateError, IndexError, KeyError):
-                pass
+        asyncio.get_event_loop().call_later(delay, self.queue.requeue, task)
 
     async def execute(self, code, **additional_values):
-        if self.retry > 10:
-            hues.warn("Не могу войти в ВК!")
+        """Выполняет код VKScript с повторами при ошибках"""
+        try:
+            return (await self.request(code, **additional_values))['response']
+
+        except VkApiError as e:
+            hues.error(str(e))
 
             return False
 
-        new = code.replace("\n", "<br>")
+    async def request(self, code, **additional_values):
+        """Выполняет код VKScript с повторами по RETRY_POLICY и возвращает ответ целиком"""
+        attempt = 0
 
-        url = f"https://api.vk.com/method/execute?access_token={self.token}&v=5.64"
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpen("execute")
 
-        async with self.session.post(url, data={"code": new, **additional_values}, **self.req_kwargs) as resp:
-            errors = []
-            error_codes = []
+            await self.bucket.acquire()
 
-            for data in json_iter_parse(await resp.text()):
-                if 'error' in data:
-                    error_data = data['error']
-                    if error_data['error_code'] == CAPTCHA_IS_NEEDED:
-                        captcha_key = await vkplus.enter_captcha(error_data["captcha_img"])
+            attempt += 1
 
-                        if not captcha_key:
-                            return False
+            try:
+                data = await self._execute(code, **additional_values)
 
-                        new_data = {"captcha_key": captcha_key, "captcha_sid": error_data["captcha_sid"]}
-                        new_data.update(additional_values)
+            except VkApiError as e:
+                error = e
 
-                        return await self.execute(code, **new_data)
+            else:
+                self.report_success()
 
-                    error_codes.append(error_data['error_code'])
-                    errors.append(error_data)
+                return data
 
-                if 'response' in data:
-                    for error in errors:
-                        hues.warn(str(error))
+            self.report_failure(error)
+
+            if not RETRY_POLICY.should_retry(error.code, attempt):
+                self.report_account_failure(error)
+                raise error
+
+            if error.code == CAPTCHA_IS_NEEDED:
+                captcha_key = await vkplus.enter_captcha(error.error["captcha_img"])
 
-                    self.retry = 0
+                if not captcha_key:
+                    self.report_account_failure(error)
+                    raise error
 
-                    if isinstance(data['response'], list) and data['response'] and data['response'][0] is False:
-                        error_codes.append("...")
-                        errors.append(data.get("execute_errors", "unknown"))
+                additional_values = dict(additional_values, captcha_key=captcha_key,
+                                         captcha_sid=error.error["captcha_sid"])
 
-                        hues.error(data.get("execute_errors", "unknown"))
+            elif error.code == AUTHORIZATION_FAILED:
+                hues.warn("Пользователь не отвечает. Попробую переполучить токен.")
 
-                    if data['response'] is None:
-                        error_codes.append(INTERNAL_ERROR)
-                        errors.append("unknown")
+                await self.relogin()
 
-                    return data['response']
+            await asyncio.sleep(RETRY_POLICY.delay(error.code, attempt))
 
-            if INTERNAL_ERROR in error_codes:
-                hues.warn("Ошибка у ВК")
+    async def relogin(self):
+        """Переполучает токен пользователя. Если токен уже переполучается - ничего не делает"""
+        if self.app_id == -1 or self.auth_lock.locked():
+            return
 
-                if self.app_id != -1:
-                    await self.user(self.username, self.password, self.app_id, self.scope)
+        async with self.auth_lock:
+            await self.user(self.username, self.password, self.app_id, self.scope)
 
-                self.retry += 1
+    async def _execute(self, code, **additional_values):
+        """Отправляет код VKScript один раз. Возвращает ответ целиком или выбрасывает VkApiError"""
+        new = code.replace("\n", "<br>")
 
-                await asyncio.sleep(1)
+        url = f"{API_URL}execute?access_token={self.token}&v={API_VERSION}"
 
-                return await self.execute(code)
+        try:
+            with VK_EXECUTE_SECONDS.time():
+                async with self.session.post(url, data={"code": new, **additional_values}, timeout=request_timeout(),
+                                             **self.req_kwargs) as resp:
+                    response = await resp.read()
 
-            if AUTHORIZATION_FAILED in error_codes:
-                hues.warn("Пользователь не отвечает. Попробую переполучить токен.")
+            errors = []
 
-                if self.app_id != -1:
-                    await self.user(self.username, self.password, self.app_id, self.scope)
+            for data in json_iter_parse(response):
+                if 'error' in data:
+                    errors.append(data['error'])
 
-                self.retry += 1
+                if 'response' in data:
+                    for error in errors:
+                        hues.warn(str(error))
 
-                return await self.execute(code)
+                    if data.get("execute_errors"):
+                        hues.warn(str(data["execute_errors"]))
 
+                    return data
+
+        except (asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+            raise VkApiError(NO_RESPONSE, f"Не удалось получить ответ от ВК: {e!r}", "execute")
+
+        if errors:
             hues.error(errors)
 
-        return False
+            raise VkApiError.from_error(errors[0], "execute")
+
+        raise VkApiError(NO_RESPONSE, "Пустой ответ от ВК", "execute")
 
     async def user(self, username, password, app_id, scope):
         self.username = username
@@ -194,28 +682,77 @@ class VkClient:
         self.app_id = app_id
         self.scope = scope
 
-        retries = 5
-        for i in range(retries):
-            self.token = await get_token(username, password, app_id, scope)
+        self_data = None
 
-            if self.token:
-                break
+        # Сохранённый токен проверяем одним запросом, и только если он не подошёл - входим по паролю
+        token = token_store.get(username, app_id, scope)
+
+        if token:
+            self_data = await self.check_token(token)
+
+        if self_data:
+            self.token = token
+
+        else:
+            token_store.remove(username, app_id, scope)
+
+            expires_in = 0
+
+            retries = 5
+            for i in range(retries):
+                self.token, expires_in = await get_token(username, password, app_id, scope)
 
-        if not self.token:
-            return hues.error("Can't get token!")
+                if self.token:
+                    break
 
-        self_data = await self.execute("return API.account.getProfileInfo();")
+            if not self.token:
+                hues.error("Can't get token!")
+                return False
+
+            token_store.save(username, app_id, scope, self.token, expires_in)
+
+            self_data = await self.execute("return API.account.getProfileInfo();")
+
+            if not self_data:
+                hues.error(f"Не удалось получить данные пользователя {username}")
+                return False
 
         hues.info(f"Вошёл как: {self_data['first_name']} {self_data['last_name']} "
                   f"(https://vk.com/{self_data['screen_name']})")
 
+        return True
+
+    async def check_token(self, token):
+        """Проверяет токен пользователя. Возвращает данные профиля или None, если токен не действителен"""
+        await self.bucket.acquire()
+
+        url = f"{API_URL}account.getProfileInfo"
+
+        try:
+            async with self.session.post(url, data={"access_token": token, "v": API_VERSION},
+                                         timeout=request_timeout(), **self.req_kwargs) as resp:
+                data = codec.loads(await resp.read())
+
+        except (asyncio.TimeoutError, aiohttp.ClientError, ValueError):
+            return None
+
+        return data.get("response")
+
     async def group(self, token):
         self.token = token
 
-        self_data = (await self.execute("return API.groups.getById();"))[0]
+        result = await self.execute("return API.groups.getById();")
+
+        if not result:
+            hues.error("Не удалось войти по токену группы")
+            return False
+
+        self_data = result[0]
 
         hues.info(f"Вошёл как: {self_data['name']} (https://vk.com/{self_data['screen_name']})")
 
+        return True
+
 
 ############################################################################
 # Thanks to: https://github.com/pohmelie/aiovk
@@ -258,12 +795,9 @@ def get_url_query(url):
     return url_query
 
 
-def json_iter_parse(response_text):
-    decoder = json.JSONDecoder(strict=False)
-    idx = 0
-    while idx < len(response_text):
-        obj, idx = decoder.raw_decode(response_text, idx)
-        yield obj
+def json_iter_parse(response):
+    """Разбирает ответ ВК (байты или строку), который может содержать несколько JSON объектов подряд"""
+    return codec.iter_loads(response)
 
 
 ############################################################################
@@ -297,11 +831,21 @@ async def auth_captcha_is_needed(response, login_form_data, captcha_url, session
         await resp.text()
 
 
+def token_from_query(url_query):
+    """Возвращает токен и срок его действия в секундах (0 - бессрочный)"""
+    try:
+        expires_in = int(url_query.get('expires_in', 0))
+    except ValueError:
+        expires_in = 0
+
+    return url_query['access_token'], expires_in
+
+
 #############################################################################
 async def get_token(username, password, app_id, scope):
     url_get_token = "https://oauth.vk.com/authorize"
 
-    with aiohttp.ClientSession() as session:
+    async with transport.new_session() as session:
         await login(username, password, session)
 
         token_data = {
@@ -330,10 +874,10 @@ async def get_token(username, password, app_id, scope):
                 response_url_query2 = {}
 
             if 'access_token' in response_url_query1:
-                return response_url_query1['access_token']
+                return token_from_query(response_url_query1)
 
             elif 'access_token' in response_url_query2:
-                return response_url_query2['access_token']
+                return token_from_query(response_url_query2)
 
             else:
                 form_action = get_form_action(html)
@@ -350,12 +894,12 @@ async def get_token(username, password, app_id, scope):
                     response_url_query2 = {}
 
                 if 'access_token' in response_url_query1:
-                    return response_url_query1['access_token']
+                    return token_from_query(response_url_query1)
 
                 elif 'access_token' in response_url_query2:
-                    return response_url_query2['access_token']
+                    return token_from_query(response_url_query2)
 
-        return None
+        return None, 0
 
 
 async def login(username, password, session):
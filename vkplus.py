@@ -3,22 +3,34 @@ import asyncio
 import json
 import random
 import string
+from collections import OrderedDict
 from typing import Optional, List, Dict, Union, BinaryIO, Tuple
 
 import aiohttp
 from captcha_solver import CaptchaSolver
 
 import settings
+from cache import MISSING, ResponseCache
 from database import *
 from methods import is_available_from_group
 from methods import is_available_from_public
-from utils import chunks, Attachment, RequestFuture, SenderGroup, SenderUser, Wait
-from vkapi import VkClient
+from methods import is_read_only
+from methods import method_priority
+from metrics import VK_CACHE_HITS, VK_CACHE_MISSES, VK_REQUESTS_COALESCED
+from utils import chunks, Attachment, Priority, RequestFuture, SenderGroup, SenderUser, Wait
+from utils import request_key, request_priority
+from transport import transport
+from vkapi import RequestDropped, VkApiError, VkClient
 
 solver = None
 
 from settings import CAPTCHA_KEY, CAPTCHA_SERVER, GROUP_ID
 
+try:
+    from settings import AUTH_CONCURRENCY, AUTH_TIMEOUT
+except ImportError:
+    AUTH_CONCURRENCY, AUTH_TIMEOUT = 5, 60
+
 if CAPTCHA_KEY and CAPTCHA_KEY:
     solver = CaptchaSolver(CAPTCHA_SERVER, api_key=CAPTCHA_KEY)
 
@@ -33,17 +45,15 @@ async def enter_captcha(url: str):
     if not solver:
         return hues.warn('Введите данные для сервиса решения капч в settings.py!')
 
-    with aiohttp.ClientSession() as session:
-        try:
-            with session as ses:
-                async with ses.get(url) as resp:
-                    img_data = await resp.read()
-                    data = solver.solve_captcha(img_data)
-                    return data
-        except Exception as e:
-            hues.error(e)
+    try:
+        async with transport.session().get(url) as resp:
+            img_data = await resp.read()
+            data = solver.solve_captcha(img_data)
+            return data
+    except Exception as e:
+        hues.error(e)
 
-            return "0"
+        return "0"
 
 
 async def enter_confirmation_сode():
@@ -57,16 +67,108 @@ async def enter_confirmation_сode():
     return code
 
 
+# Сколько собеседников помнить для закрепления за ними аккаунтов
+STICKY_PEERS_SIZE = 10000
+
+
+class ClientRouter(object):
+    """Выбирает клиент VK API (аккаунт) для запроса
+
+    Запрос уходит наименее загруженному клиенту из тех, что не исключены из ротации.
+    Переписка с одним собеседником закрепляется за одним аккаунтом, а беседы всегда
+    обслуживает основной аккаунт (первый), т.к. chat_id у каждого аккаунта свой, а
+    сообщения из бесед приходят через Long Poll основного аккаунта.
+    """
+
+    __slots__ = ("clients", "sticky")
+
+    def __init__(self, clients: List[VkClient]):
+        self.clients = clients
+        self.sticky = OrderedDict()  # собеседник -> клиент
+
+    @staticmethod
+    def get_peer(key: str, data: Optional[Dict]):
+        """Возвращает (собеседник, это беседа) для методов messages.*, иначе (None, False)"""
+        if not data or not key.startswith("messages."):
+            return None, False
+
+        if 'chat_id' in data:
+            return 2000000000 + int(data['chat_id']), True
+
+        for name in ('peer_id', 'user_id'):
+            if name in data:
+                try:
+                    peer = int(data[name])
+                except (TypeError, ValueError):
+                    return None, False
+
+                return peer, peer > 2000000000
+
+        return None, False
+
+    def least_loaded(self) -> Optional[VkClient]:
+        if not self.clients:
+            return None
+
+        candidates = [c for c in self.clients if c.healthy()] or self.clients
+
+        return min(candidates, key=lambda c: c.load)
+
+    def choose(self, key: str, data: Optional[Dict], target: Optional[int]=None) -> Optional[VkClient]:
+        if not self.clients:
+            return None
+
+        if target is not None:
+            return self.clients[target % len(self.clients)]
+
+        peer, is_chat = self.get_peer(key, data)
+
+        if peer is None:
+            return self.least_loaded()
+
+        if is_chat:
+            return self.clients[0]
+
+        client = self.sticky.get(peer)
+
+        if client is not None and client.healthy():
+            self.sticky.move_to_end(peer)
+            return client
+
+        client = self.least_loaded()
+
+        self.sticky[peer] = client
+        self.sticky.move_to_end(peer)
+
+        while len(self.sticky) > STICKY_PEERS_SIZE:
+            self.sticky.popitem(last=False)
+
+        return client
+
+
 class VkPlus(object):
-    def __init__(self, bot, users_data: list=None, proxies: list=None, app_id: int=5982451, scope=140489887):
+    def __init__(self, bot, users_data: list=None, proxies: list=None, app_id: int=5982451, scope=140489887,
+                 buckets: list=None):
         self.bot = bot
         self.users = []
         self.tokens = []
         self.scope = scope
         self.group = False
         self.app_id = app_id
-        self.current_user = 0
-        self.current_token = 0
+
+        self.user_router = ClientRouter(self.users)
+        self.token_router = ClientRouter(self.tokens)
+
+        # Выполняющиеся запросы на чтение и количество присоединившихся к ним повторов
+        self.in_flight = {}
+        self.coalesced = 0
+
+        # Кэш ответов редко меняющихся методов
+        self.cache = ResponseCache()
+
+        VK_REQUESTS_COALESCED.track(lambda: self.coalesced)
+        VK_CACHE_HITS.track(lambda: self.cache.hits)
+        VK_CACHE_MISSES.track(lambda: self.cache.misses)
 
         self.proxies = proxies
         if not proxies:
@@ -76,76 +178,227 @@ class VkPlus(object):
         if not users_data:
             self.users_data = []
 
+        # Ограничители частоты запросов аккаунтов из users_data (общие для нескольких процессов)
+        self.buckets = buckets
+
         loop = asyncio.get_event_loop()
         loop.run_until_complete(self.init_vk())
 
-    def get_default_sender(self, key: str) -> Union[SenderUser, SenderGroup]:
+    def get_default_sender(self, key: str, target: int=None) -> Union[SenderUser, SenderGroup]:
+        """Возвращает отправителя запроса. Если target не указан, аккаунт выберет ClientRouter"""
         if self.group and is_available_from_group(key):
-            send_from = SenderGroup(self.current_token)
+            send_from = SenderGroup(target)
 
         elif is_available_from_public(key):
-            send_from = SenderUser(self.current_user)
+            send_from = SenderUser(target)
 
         else:
-            send_from = SenderUser(self.current_user)
+            send_from = SenderUser(target)
+
+        return send_from
+
+    def get_pinned_sender(self, key: str) -> Union[SenderUser, SenderGroup]:
+        """Возвращает отправителя с конкретным аккаунтом - для цепочек запросов, которые должны
+        выполняться от одного аккаунта (например, загрузка файлов)"""
+        send_from = self.get_default_sender(key)
+
+        if send_from.GROUP:
+            clients, router = self.tokens, self.token_router
+        else:
+            clients, router = self.users, self.user_router
+
+        client = router.least_loaded()
+
+        if client is not None:
+            send_from.target = clients.index(client)
 
         return send_from
 
     async def init_vk(self):
-        """Инициализация сессий ВК API"""
-        current_proxy = 0
+        """Инициализация сессий ВК API
+
+        Аккаунты авторизуются параллельно (не больше AUTH_CONCURRENCY одновременно), на каждый
+        даётся AUTH_TIMEOUT секунд. Аккаунты, которые не смогли авторизоваться, пропускаются.
+        """
+        semaphore = asyncio.Semaphore(AUTH_CONCURRENCY)
+
+        accounts = []
 
-        for user in self.users_data:
+        for i, user in enumerate(self.users_data):
             if self.proxies:
-                proxy = self.proxies[current_proxy % len(self.proxies)]
-                current_proxy += 1
+                proxy = self.proxies[i % len(self.proxies)]
 
             else:
                 proxy = None
 
-            if len(user) == 1:
-                client = VkClient(proxy)
-                await client.group(user[0])
+            bucket = self.buckets[i] if self.buckets else None
+
+            accounts.append((user, VkClient(proxy, bucket)))
+
+        results = await asyncio.gather(*(self.init_client(client, user, semaphore) for user, client in accounts))
 
+        for (user, client), success in zip(accounts, results):
+            if not success:
+                client.close()
+                continue
+
+            if len(user) == 1:
                 self.tokens.append(client)
                 self.group = True
 
             else:
-                client = VkClient(proxy)
-                await client.user(user[0], user[1], self.app_id, self.scope)
-
                 self.users.append(client)
 
-    async def method(self, key: str, data=None, send_from=None, wait=Wait.YES):
+        failed = results.count(False)
+        if failed:
+            hues.error(f"Не удалось авторизовать аккаунтов: {failed} из {len(accounts)}")
+
+    async def init_client(self, client: VkClient, user: tuple, semaphore: asyncio.Semaphore) -> bool:
+        name = "группа" if len(user) == 1 else user[0]
+
+        async with semaphore:
+            try:
+                if len(user) == 1:
+                    return await asyncio.wait_for(client.group(user[0]), AUTH_TIMEOUT)
+
+                return await asyncio.wait_for(client.user(user[0], user[1], self.app_id, self.scope), AUTH_TIMEOUT)
+
+            except asyncio.TimeoutError:
+                hues.error(f"Аккаунт ({name}) не успел авторизоваться за {AUTH_TIMEOUT} сек.")
+
+            except Exception as e:
+                hues.error(f"Ошибка при авторизации аккаунта ({name}): {e!r}")
+
+        return False
+
+    @staticmethod
+    def get_default_priority(key: str) -> Priority:
+        priority = request_priority.get()
+
+        if priority is None:
+            priority = method_priority(key)
+
+        return priority
+
+    async def method(self, key: str, data=None, send_from=None, wait=Wait.YES, priority: Priority=None):
         """Выполнение метода API VK с дополнительными параметрами"""
         if send_from is None:
             send_from = self.get_default_sender(key)
 
-        task = RequestFuture(key, data, send_from)
+        if priority is None:
+            priority = self.get_default_priority(key)
+
+        request = request_key(key, data)
+
+        if self.cache.cacheable(key):
+            result = self.cache.lookup(key, request)
+
+            if result is not MISSING:
+                return self.cached_result(key, data, send_from, result, wait)
+
+        else:
+            self.cache.invalidate_related(key)
+
+        flight_key = None
+
+        # Одинаковые запросы на чтение, отправленные пока первый ещё выполняется, получают его результат.
+        # Запросы с закреплённым аккаунтом не объединяются: ответ может зависеть от аккаунта
+        # (например, адрес сервера загрузки)
+        if is_read_only(key) and send_from.target is None:
+            flight_key = (send_from.GROUP, send_from.target, request)
+
+            task = self.in_flight.get(flight_key)
+
+            if task is not None and not task.done():
+                self.coalesced += 1
+
+                return await self.wait_result(task, wait)
+
+        # random_id не даёт ВК отправить сообщение повторно, если execute придётся повторить
+        # Словарь копируется: плагин может отправить несколько сообщений, меняя в нём только текст
+        if key == 'messages.send' and data is not None and 'random_id' not in data:
+            data = dict(data, random_id=random.randint(1, 2 ** 31 - 1))
+
+        task = RequestFuture(key, data, send_from, priority)
 
         client = None
 
         if self.users and send_from.USER:
-            client = self.users[send_from.target % len(self.users)]
-            self.current_user += 1
+            client = self.user_router.choose(key, data, send_from.target)
 
         elif self.tokens and send_from.GROUP:
-            client = self.tokens[send_from.target % len(self.tokens)]
-            self.current_token += 1
+            client = self.token_router.choose(key, data, send_from.target)
 
         if not client:
             hues.error(f"Для выполнения метода({task.key}) необходимо ввести недостающие данные пользователя "
                        f"или токен группы.")
             return None
 
-        client.queue.put_nowait(task)
+        if not await client.queue.put(task):
+            task.set_exception(RequestDropped(key))
+
+            if wait == Wait.CUSTOM:
+                return task
+
+            task.exception()  # Ошибка уже учтена в статистике очереди, в лог её не пишем
+            return None
+
+        if flight_key is not None:
+            self.in_flight[flight_key] = task
+            task.add_done_callback(lambda t: self.forget_in_flight(flight_key, t))
+
+        if self.cache.cacheable(key):
+            task.add_done_callback(lambda t: self.cache_result(request, t))
+
+        else:
+            # Запрос на чтение, выполнявшийся одновременно с изменением, мог снова положить в кэш
+            # старые данные - поэтому кэш очищается и после выполнения изменяющего метода
+            task.add_done_callback(lambda t: self.cache.invalidate_related(key))
+
+        return await self.wait_result(task, wait)
 
+    def cache_result(self, request: str, task: RequestFuture):
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        result = task.result()
+
+        if result is not None and result is not False:
+            self.cache.store(task.key, request, result)
+
+    @staticmethod
+    def cached_result(key: str, data, send_from, result, wait: Wait):
+        if wait == Wait.CUSTOM:
+            task = RequestFuture(key, data, send_from)
+            task.set_result(result)
+
+            return task
+
+        if wait == Wait.YES:
+            return result
+
+    def forget_in_flight(self, flight_key, task):
+        if self.in_flight.get(flight_key) is task:
+            del self.in_flight[flight_key]
+
+    @staticmethod
+    def log_failure(task: RequestFuture):
+        if not task.cancelled() and task.exception() is not None:
+            hues.warn(f"Запрос к вк завершился с ошибкой: {task.exception()}")
+
+    async def wait_result(self, task: RequestFuture, wait: Wait):
         if wait == Wait.NO:
+            # Результат никто не ждёт, поэтому ошибку нужно хотя бы записать в лог
+            task.add_done_callback(self.log_failure)
+
             return None
 
         elif wait == Wait.YES:
             try:
-                return await asyncio.wait_for(task, 90)
+                # shield - чтобы таймаут одного ожидающего не отменял общий для нескольких вызовов запрос
+                return await asyncio.wait_for(asyncio.shield(task), 90)
+            except (VkApiError, RequestDropped) as e:
+                hues.warn(f"Запрос к вк завершился с ошибкой: {e}")
             except Exception as e:
                 import traceback
                 hues.error("Запрос к вк завершился с ошибкой")
@@ -155,7 +408,7 @@ class VkPlus(object):
             return task
 
     async def upload_doc(self, multipart_data: BinaryIO, filename="image.png") -> Optional[Attachment]:
-        sender = self.get_default_sender("docs.getWallUploadServer")
+        sender = self.get_pinned_sender("docs.getWallUploadServer")
 
         data = aiohttp.FormData()
         data.add_field('file',
@@ -169,9 +422,8 @@ class VkPlus(object):
 
         upload_url = (await self.method('docs.getWallUploadServer', v, send_from=sender))['upload_url']
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.post(upload_url, data=data) as resp:
-                result = json.loads(await resp.text())
+        async with transport.session().post(upload_url, data=data) as resp:
+            result = json.loads(await resp.text())
 
         if not result:
             return None
@@ -208,7 +460,7 @@ class VkPlus(object):
 
                 await db.update(status)
 
-        sender = self.get_default_sender("photos.getMessagesUploadServer")
+        sender = self.get_pinned_sender("photos.getMessagesUploadServer")
 
         data = aiohttp.FormData()
         data.add_field('photo',
@@ -218,9 +470,8 @@ class VkPlus(object):
 
         upload_url = (await self.method('photos.getMessagesUploadServer', send_from=sender))['upload_url']
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.post(upload_url, data=data) as resp:
-                result = json.loads(await resp.text())
+        async with transport.session().post(upload_url, data=data) as resp:
+            result = json.loads(await resp.text())
 
         if not result:
             return None
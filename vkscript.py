@@ -0,0 +1,68 @@
+# Перевод запросов к VK API в код VKScript для метода execute
+import json
+import math
+from functools import lru_cache
+
+EXECUTE_PREFIX = "return ["
+EXECUTE_SUFFIX = "];"
+
+
+def string_literal(value: str) -> str:
+    """Возвращает строку в виде строкового литерала VKScript"""
+    try:
+        value.encode()
+    except UnicodeEncodeError:
+        # Одиночные суррогаты нельзя передать в UTF-8, поэтому экранируем всё
+        return json.dumps(value)
+
+    # U+2028 и U+2029 в JavaScript-подобных языках считаются переводом строки
+    return json.dumps(value, ensure_ascii=False).replace("\u2028", "\\u2028").replace("\u2029", "\\u2029")
+
+
+def literal(value) -> str:
+    """Возвращает значение в виде литерала VKScript с сохранением типа"""
+    if value is None:
+        return "null"
+
+    # ВК API принимает флаги в виде 1 и 0
+    if isinstance(value, bool):
+        return "1" if value else "0"
+
+    if isinstance(value, int):
+        return str(value)
+
+    if isinstance(value, float):
+        return repr(value) if math.isfinite(value) else "null"
+
+    if isinstance(value, str):
+        return string_literal(value)
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return "[" + ",".join(literal(v) for v in value) + "]"
+
+    # Объекты (например, keyboard) ВК API ожидает в виде JSON-строки
+    if isinstance(value, dict):
+        return string_literal(json.dumps(value, ensure_ascii=False))
+
+    return string_literal(str(value))
+
+
+@lru_cache(maxsize=1024)
+def call_template(key: str, names: tuple) -> str:
+    """Возвращает шаблон обращения к методу key с параметрами names для подстановки через %"""
+    args = ",".join(json.dumps(name).replace("%", "%%") + ":%s" for name in names)
+
+    return "API." + key.replace("%", "%%") + "({" + args + "})"
+
+
+def render_call(key: str, data: dict = None) -> str:
+    """Возвращает обращение к методу API в виде кода VKScript"""
+    if not data:
+        return "API." + key + "({})"
+
+    return call_template(key, tuple(data)) % tuple(literal(v) for v in data.values())
+
+
+def render_batch(calls) -> str:
+    """Собирает готовые обращения к методам в код execute, возвращающий массив их результатов"""
+    return EXECUTE_PREFIX + ",".join(calls) + EXECUTE_SUFFIX
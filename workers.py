@@ -0,0 +1,207 @@
+# Режим с несколькими процессами: один процесс получает события Long Poll, остальные их обрабатывают
+import asyncio
+import multiprocessing
+import queue
+import time
+import traceback
+from typing import List
+
+import hues
+
+from dispatcher import event_peer
+
+try:
+    from settings import WORKER_PROCESSES, EVENT_QUEUE_SIZE
+except ImportError:
+    WORKER_PROCESSES, EVENT_QUEUE_SIZE = 0, 1000
+
+# Процессы запускаются заново, а не копируются (fork), чтобы не унаследовать цикл событий и соединения
+CONTEXT = multiprocessing.get_context("spawn")
+
+# Сигнал обработчику, что событий больше не будет
+STOP = None
+
+
+class SharedTokenBucket(object):
+    """Ограничитель частоты запросов "ведро с токенами", общий для нескольких процессов
+
+    То же, что utils.TokenBucket, но состояние хранится в общей памяти.
+    """
+
+    __slots__ = ("capacity", "rate", "state")
+
+    def __init__(self, capacity: int, interval: float):
+        self.capacity = max(1, capacity)
+        self.rate = self.capacity / interval if interval > 0 else float("inf")
+
+        # Количество токенов и время последнего пополнения (-1 - ещё не пополнялось)
+        self.state = CONTEXT.Array("d", [float(self.capacity), -1.0])
+
+    @property
+    def tokens(self) -> float:
+        return self.state[0]
+
+    def _refill(self, now: float) -> float:
+        # Вызывается под блокировкой state
+        tokens, updated = self.state[0], self.state[1]
+
+        if updated >= 0:
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+
+        self.state[0] = tokens
+        self.state[1] = now
+
+        return tokens
+
+    def refill(self, now: float) -> None:
+        with self.state.get_lock():
+            self._refill(now)
+
+    def try_acquire(self, now: float) -> float:
+        """Пробует забрать токен. Возвращает 0, если получилось, иначе - сколько секунд ждать"""
+        with self.state.get_lock():
+            tokens = self._refill(now)
+
+            if tokens >= 1:
+                self.state[0] = tokens - 1
+                return 0
+
+        return (1 - tokens) / self.rate
+
+    async def acquire(self) -> None:
+        """Ждёт, пока в ведре не появится токен, и забирает его"""
+        while True:
+            # time.monotonic одинаково во всех процессах
+            delay = self.try_acquire(time.monotonic())
+
+            if not delay:
+                return
+
+            await asyncio.sleep(delay)
+
+
+class WorkerPool(object):
+    """Процессы-обработчики событий
+
+    Событие передаётся процессу по ID диалога, поэтому события одного диалога
+    обрабатываются одним процессом по порядку. Интерфейс - как у dispatcher.EventDispatcher.
+    """
+
+    __slots__ = ("workers", "buckets", "queues", "processes")
+
+    def __init__(self, workers: int=WORKER_PROCESSES, buckets: List[SharedTokenBucket]=None):
+        self.workers = max(1, workers)
+        self.buckets = buckets
+
+        self.queues = [CONTEXT.Queue(EVENT_QUEUE_SIZE) for _ in range(self.workers)]
+        self.processes = []
+
+    @property
+    def queued(self) -> int:
+        try:
+            return sum(q.qsize() for q in self.queues)
+        except NotImplementedError:  # macOS
+            return 0
+
+    def start(self) -> None:
+        if self.processes:
+            return
+
+        for number, events in enumerate(self.queues):
+            process = CONTEXT.Process(target=worker_main, args=(number, events, self.buckets),
+                                      name=f"vbot-worker-{number}", daemon=True)
+            process.start()
+
+            self.processes.append(process)
+
+        hues.info(f"Запущено процессов-обработчиков: {self.workers}")
+
+    async def put(self, event) -> None:
+        """Передаёт событие процессу-обработчику. Если его очередь заполнена - ждёт"""
+        peer = event_peer(event)
+        events = self.queues[(peer if peer is not None else 0) % self.workers]
+
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            await asyncio.get_event_loop().run_in_executor(None, events.put, event)
+
+    async def stop(self, timeout: float=10) -> None:
+        loop = asyncio.get_event_loop()
+
+        for events in self.queues:
+            await loop.run_in_executor(None, events.put, STOP)
+
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, timeout)
+
+            if process.is_alive():
+                process.terminate()
+
+        self.processes = []
+
+
+async def consume(bot, events) -> None:
+    """Передаёт события из очереди процесса обработчикам бота, пока не придёт STOP"""
+    loop = asyncio.get_event_loop()
+
+    bot.dispatcher.start()
+
+    while True:
+        # Ждём событие в отдельном потоке, а накопившиеся забираем без ожидания
+        event = await loop.run_in_executor(None, events.get)
+
+        while event is not STOP:
+            await bot.dispatcher.put(event)
+
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                break
+
+        if event is STOP:
+            break
+
+    await bot.dispatcher.join()
+    await bot.dispatcher.stop()
+
+
+def worker_main(number: int, events, buckets: List[SharedTokenBucket]) -> None:
+    """Точка входа процесса-обработчика: свои плагины и система команд, общий лимит запросов"""
+    import plugin_system
+    import vbot
+    from database import check_white_list, user_cache
+    from metrics import METRICS_PORT, registry
+    from transport import transport
+    from utils import BotMode
+
+    loop = asyncio.get_event_loop()
+
+    # Одного пользователя могут менять несколько процессов (личные сообщения и беседы)
+    user_cache.share()
+
+    # Периодические задачи плагинов выполняет только первый процесс
+    plugin_system.primary_process = number == 0
+
+    bot = vbot.Bot(mode=BotMode.WORKER, buckets=buckets)
+    loop.run_until_complete(check_white_list(bot))
+
+    # Метрики обработки сообщений собираются в процессе-обработчике, поэтому у каждого - свой порт
+    loop.run_until_complete(registry.start_server(port=METRICS_PORT + 1 + number if METRICS_PORT else 0))
+
+    hues.success(f"Процесс-обработчик {number} готов к работе")
+
+    try:
+        loop.run_until_complete(consume(bot, events))
+
+    except KeyboardInterrupt:
+        pass
+
+    except Exception:
+        hues.error(f"Процесс-обработчик {number} завершился с ошибкой")
+        traceback.print_exc()
+
+    finally:
+        loop.run_until_complete(user_cache.close())
+        loop.run_until_complete(registry.stop_server())
+        loop.run_until_complete(transport.close())